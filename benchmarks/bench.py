@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+benchmarks of jumbonet against the in process ssh server of benchmarks/server.py
+
+    python3 benchmarks/bench.py --out results.json
+    python3 benchmarks/bench.py --out new.json --compare results.json
+
+measures
+ - launch: Remote.popen calls per second and how long until all processes exited
+ - throughput: bytes and lines per second through Process.read_outputs to a listener
+ - latency: from a line being written on the remote to the Subscriber callback
+ - scaling: N remotes x M processes printing a fixed amount of lines each
+ - batch: short commands through Remote.run_batch against a popen each
+the server runs on the same host, so the numbers show what jumbonet costs, not what a network costs
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shlex
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import paramiko
+from jumbonet import master, metrics
+import server as sshserver
+
+log = logging.getLogger(__name__)
+
+
+class Collector(master.Subscriber):
+    """counts what arrives and lets the benchmark wait for a number of exits"""
+    def __init__(self, expected):
+        self.expected = expected
+        self.lines = 0
+        self.bytes = 0
+        self.exits = []
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        if expected == 0:
+            self.done.set()
+
+    def receive_out(self, remotename, uuid, args, lines):
+        n = sum(len(line) + 1 for line in lines)
+        with self.lock:
+            self.lines += len(lines)
+            self.bytes += n
+
+    def receive_err(self, remotename, uuid, args, lines):
+        log.error("{} {}: {}".format(remotename, args, lines[:3]))
+
+    def receive_status(self, remotename, uuid, args, exitcode):
+        with self.lock:
+            self.exits.append(exitcode)
+            if len(self.exits) >= self.expected:
+                self.done.set()
+
+    def wait(self, timeout):
+        if not self.done.wait(timeout):
+            raise Exception("Timed out with {} of {} processes exited".format(len(self.exits), self.expected))
+
+
+class Latency(Collector):
+    """the remote prints its clock, the callback compares it with ours"""
+    def __init__(self, expected):
+        super().__init__(expected)
+        self.samples = []
+
+    def receive_out(self, remotename, uuid, args, lines):
+        now = time.time()
+        for line in lines:
+            try:
+                self.samples.append(now - float(line))
+            except ValueError:
+                pass
+
+
+def connect(net, srv, n):
+    return net.add_remotes([dict(name = "bench{}".format(i), host = srv.host, user = "bench", remote_password = "bench", \
+                                 port = srv.port) for i in range(n)])
+
+
+def percentile(samples, q):
+    if len(samples) == 0:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def bench_launch(net, srv, args):
+    h = connect(net, srv, 1)[0]
+    c = Collector(args.launches)
+    start = time.perf_counter()
+    for i in range(args.launches):
+        h.popen(["true"], c, listen_error = False)
+    launched = time.perf_counter() - start
+    c.wait(args.timeout)
+    finished = time.perf_counter() - start
+    return {"processes": args.launches, "popen_seconds": launched, "popen_per_second": args.launches / launched, \
+            "all_exited_seconds": finished, "exits_per_second": args.launches / finished, \
+            "failed": sum(1 for code in c.exits if code != 0), "max_sessions": h.max_sessions}
+
+
+def bench_throughput(net, srv, args):
+    h = connect(net, srv, 1)[0]
+    c = Collector(1)
+    line = "x" * (args.line_length - 1)
+    command = "yes {} | head -c {}".format(line, args.megabytes * 1000 * 1000)
+    start = time.perf_counter()
+    h.popen([command], c, listen_output = True)
+    c.wait(args.timeout)
+    elapsed = time.perf_counter() - start
+
+    # the same bytes without a pty, decoding and line splitting
+    raw = Collector(1)
+    start = time.perf_counter()
+    p = h.popen([command], raw, pty = False, stdout_to = os.devnull)
+    raw.wait(args.timeout)
+    binary = time.perf_counter() - start
+    return {"bytes": c.bytes, "lines": c.lines, "seconds": elapsed, "megabytes_per_second": c.bytes / elapsed / 1e6, \
+            "lines_per_second": c.lines / elapsed, "binary_seconds": binary, \
+            "binary_megabytes_per_second": p.stdout_reader.received / binary / 1e6}
+
+
+def bench_latency(net, srv, args):
+    h = connect(net, srv, 1)[0]
+    c = Latency(1)
+    script = "import time\nfor i in range({}):\n    print(repr(time.time()), flush = True)\n    time.sleep({})\n" \
+             .format(args.samples, args.interval)
+    h.popen(["python3", "-c", shlex.quote(script)], c, listen_output = True)
+    c.wait(args.timeout)
+    ms = [s * 1000 for s in c.samples]
+    return {"samples": len(ms), "interval_seconds": args.interval, "mean_ms": statistics.mean(ms) if ms else None, \
+            "p50_ms": percentile(ms, 0.5), "p90_ms": percentile(ms, 0.9), "p99_ms": percentile(ms, 0.99), \
+            "max_ms": max(ms) if ms else None}
+
+
+def bench_scaling(net, srv, args):
+    results = []
+    for n in args.remotes:
+        for m in args.processes:
+            scenario = master.Master()
+            scenario.mainloop()
+            try:
+                remotes = connect(scenario, srv, n)
+                c = Collector(n * m)
+                start = time.perf_counter()
+                for h in remotes:
+                    for i in range(m):
+                        h.popen(["seq", "1", str(args.lines)], c, listen_output = True)
+                c.wait(args.timeout)
+                elapsed = time.perf_counter() - start
+            finally:
+                scenario.shutdown()
+            results.append({"remotes": n, "processes_per_remote": m, "seconds": elapsed, "lines": c.lines, \
+                            "lines_per_second": c.lines / elapsed, "processes_per_second": n * m / elapsed})
+            log.info("scaling {}x{}: {:.3f}s".format(n, m, elapsed))
+    return results
+
+
+def bench_batch(net, srv, args):
+    h = connect(net, srv, 1)[0]
+    commands = [["echo", str(i)] for i in range(args.batch)]
+    start = time.perf_counter()
+    results = h.run_batch(commands)
+    batched = time.perf_counter() - start
+
+    c = Collector(args.batch)
+    start = time.perf_counter()
+    for command in commands:
+        h.popen(command, c, listen_output = True)
+    c.wait(args.timeout)
+    separate = time.perf_counter() - start
+    return {"commands": args.batch, "batch_seconds": batched, "popen_seconds": separate, \
+            "batch_commands_per_second": args.batch / batched, "popen_commands_per_second": args.batch / separate, \
+            "failed": sum(1 for r in results if not r.ok)}
+
+
+BENCHMARKS = {
+    "launch": bench_launch,
+    "throughput": bench_throughput,
+    "latency": bench_latency,
+    "scaling": bench_scaling,
+    "batch": bench_batch,
+}
+
+# for --compare, whether a bigger number is better
+BETTER = {"per_second": True, "seconds": False, "_ms": False}
+
+
+def compare(old, new, path = ""):
+    """print how the numbers in new moved against old"""
+    if isinstance(new, dict):
+        for key, value in new.items():
+            if isinstance(old, dict) and key in old:
+                compare(old[key], value, "{}.{}".format(path, key) if path else key)
+    elif isinstance(new, list) and isinstance(old, list):
+        for i, (o, n) in enumerate(zip(old, new)):
+            compare(o, n, "{}[{}]".format(path, i))
+    elif isinstance(new, (int, float)) and isinstance(old, (int, float)) and not isinstance(new, bool) and old != 0:
+        for suffix, bigger in BETTER.items():
+            if path.endswith(suffix):
+                change = (new - old) / old
+                worse = change < 0 if bigger else change > 0
+                print("{:60s} {:>12.4g} -> {:>12.4g} {:+7.1%}{}".format(path, old, new, change, \
+                      "  !" if worse and abs(change) > 0.1 else ""))
+                break
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "benchmark jumbonet against an in process ssh server")
+    parser.add_argument("benchmarks", nargs = "*", help = "any of {}, default all".format(", ".join(BENCHMARKS)))
+    parser.add_argument("--out", help = "write the results as json to this file")
+    parser.add_argument("--compare", help = "json results of an earlier run to compare against")
+    parser.add_argument("--launches", type = int, default = 200)
+    parser.add_argument("--megabytes", type = int, default = 50)
+    parser.add_argument("--line-length", type = int, default = 100)
+    parser.add_argument("--samples", type = int, default = 200)
+    parser.add_argument("--interval", type = float, default = 0.01)
+    parser.add_argument("--remotes", type = lambda s: [int(n) for n in s.split(",")], default = [1, 4, 16])
+    parser.add_argument("--processes", type = lambda s: [int(n) for n in s.split(",")], default = [1, 8, 32])
+    parser.add_argument("--lines", type = int, default = 10000)
+    parser.add_argument("--batch", type = int, default = 50)
+    parser.add_argument("--timeout", type = float, default = 300)
+    parser.add_argument("-v", "--verbose", action = "store_true")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark {}".format(name))
+    if len(args.benchmarks) == 0:
+        args.benchmarks = list(BENCHMARKS)
+
+    logging.basicConfig(level = logging.INFO if args.verbose else logging.WARNING)
+    # the server side transports complain about every client that hangs up
+    logging.getLogger("paramiko").setLevel(logging.INFO if args.verbose else logging.CRITICAL)
+
+    srv = sshserver.SSHServer()
+    results = {"python": platform.python_version(), "paramiko": paramiko.__version__, "platform": platform.platform(), \
+               "cpus": os.cpu_count(), "started": time.time(), "benchmarks": {}}
+    try:
+        for name in args.benchmarks:
+            net = master.Master()
+            net.mainloop()
+            metrics.REGISTRY.reset()
+            try:
+                results["benchmarks"][name] = BENCHMARKS[name](net, srv, args)
+            finally:
+                net.shutdown()
+            print("{}: {}".format(name, json.dumps(results["benchmarks"][name], indent = 1)))
+            results.setdefault("metrics", {})[name] = metrics.REGISTRY.snapshot()
+    finally:
+        srv.close()
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent = 1)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(json.load(f)["benchmarks"], results["benchmarks"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+a stand-in for sshd, runs in process on a paramiko ServerInterface
+accepts any user and password and runs exec requests as local subprocesses, which is enough to drive jumbonet
+without a real sshd or network
+
+    server = SSHServer()
+    net.add_remote("h1", "127.0.0.1", "bench", remote_password = "bench", port = server.port)
+"""
+import logging
+import os
+import signal
+import socket
+import subprocess
+import threading
+import paramiko
+
+log = logging.getLogger(__name__)
+
+CHUNK = 32768
+
+
+class SSHServer():
+    def __init__(self, host = "127.0.0.1", port = 0, max_sessions = None):
+        self.key = paramiko.RSAKey.generate(2048)
+        self.max_sessions = max_sessions
+        self.transports = []
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(128)
+        self.host, self.port = self.sock.getsockname()
+        self.run = True
+        threading.Thread(target = self._accept, name = "bench-sshd", daemon = True).start()
+
+    def _accept(self):
+        while self.run:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                break
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            t = paramiko.Transport(conn)
+            t.add_server_key(self.key)
+            self.transports.append(t)
+            t.start_server(server = Session(self.max_sessions))
+
+    def close(self):
+        self.run = False
+        self.sock.close()
+        for t in self.transports:
+            t.close()
+
+
+class Session(paramiko.ServerInterface):
+    """the server side of one ssh connection"""
+    def __init__(self, max_sessions):
+        self.max_sessions = max_sessions
+        self.running = 0
+        self.lock = threading.Lock()
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind != "session":
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+        with self.lock:
+            if self.max_sessions is not None and self.running >= self.max_sessions:
+                return paramiko.OPEN_FAILED_RESOURCE_SHORTAGE
+            self.running += 1
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        # commands run on pipes either way
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target = self._exec, args = (channel, command.decode("utf-8")), daemon = True).start()
+        return True
+
+    def _exec(self, chan, command):
+        p = subprocess.Popen(command, shell = True, stdin = subprocess.PIPE, stdout = subprocess.PIPE, \
+                             stderr = subprocess.PIPE, start_new_session = True)
+
+        def pump(src, send):
+            fd = src.fileno()
+            try:
+                while True:
+                    data = os.read(fd, CHUNK)
+                    if len(data) == 0:
+                        break
+                    send(data)
+            except OSError:
+                pass
+
+        def feed():
+            try:
+                while True:
+                    data = chan.recv(CHUNK)
+                    if len(data) == 0:
+                        break
+                    p.stdin.write(data)
+                    p.stdin.flush()
+            except (OSError, EOFError):
+                pass
+            try:
+                p.stdin.close()
+            except OSError:
+                pass
+
+        out = threading.Thread(target = pump, args = (p.stdout, chan.sendall), daemon = True)
+        err = threading.Thread(target = pump, args = (p.stderr, chan.sendall_stderr), daemon = True)
+        threading.Thread(target = feed, daemon = True).start()
+        out.start()
+        err.start()
+        out.join()
+        err.join()
+
+        if chan.closed:
+            # the client hung up on us, like sshd would hang up on the command
+            try:
+                os.killpg(p.pid, signal.SIGHUP)
+            except OSError:
+                pass
+        try:
+            chan.send_exit_status(p.wait())
+            chan.shutdown_write()
+        except (OSError, EOFError):
+            pass
+        chan.close()
+        with self.lock:
+            self.running -= 1
+
+    def check_channel_shell_request(self, channel):
+        return False
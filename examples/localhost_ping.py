@@ -47,7 +47,7 @@ class Example(testcase.Testcase):
     def postprocess(self):
         print("(4).Postprocessing")
         print("\t You could implement some postprocessing ... data collection for example")
-        print("\t Check out jumbonet.testcase.Local if you want to collect files from the remotes to a certain folder using scp")
+        print("\t Check out jumbonet.testcase.Local if you want to collect files from the remotes to a certain folder over sftp")
             
 if __name__ == "__main__":
     t = Example(allow_errors=False)
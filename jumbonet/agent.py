@@ -0,0 +1,271 @@
+import logging
+import itertools
+import json
+import shlex
+import struct
+import threading
+import traceback
+from . import vchannel
+
+log = logging.getLogger(__name__)
+
+# every frame between the controller and the agent is (kind, process id, payload length) + payload
+HEADER = struct.Struct("!BII")
+
+# controller -> agent
+SPAWN = 0
+SIGNAL = 1
+# agent -> controller
+STDOUT = 2
+STDERR = 3
+EXIT = 4
+STDIN = 5
+CLOSE_STDIN = 6
+WROTE = 7 # agent -> controller, the number of stdin bytes written (or dropped), opens the window again
+
+# the helper that is bootstrapped on the remote, it must stay self-contained and python3 only
+AGENT_SOURCE = r'''
+import json, os, pty, queue, select, signal, struct, subprocess, sys, threading
+
+HEADER = struct.Struct("!BII")
+SPAWN, SIGNAL, STDOUT, STDERR, EXIT, STDIN, CLOSE_STDIN, WROTE = range(8)
+
+out = sys.stdout.buffer
+lock = threading.Lock()
+children = {}
+stdins = {} # pid -> queue of a feed thread, None closes
+
+def send(kind, pid, payload = b""):
+    with lock:
+        out.write(HEADER.pack(kind, pid, len(payload)) + payload)
+        out.flush()
+
+def pump(pid, fd, kind, exited):
+    while True:
+        ready, _, _ = select.select([fd], [], [], 0.05)
+        if not ready:
+            if exited.is_set():
+                break
+            continue
+        try:
+            data = os.read(fd, 65536)
+        except OSError:
+            break
+        if not data:
+            break
+        send(kind, pid, data)
+    os.close(fd)
+
+def feed(pid, fd, q, tty):
+    # a command that does not read its stdin only holds up its own feed thread
+    broken = False
+    while True:
+        data = q.get()
+        if data is None:
+            break
+        if not broken:
+            try:
+                view = memoryview(data)
+                while len(view) > 0:
+                    view = view[os.write(fd, view):]
+            except OSError:
+                broken = True
+        # written or dropped, either way the controller may send more
+        send(WROTE, pid, str(len(data)).encode("utf-8"))
+    # the master of a pty is closed by its pump, the controller ends the input with ^D there
+    if not tty:
+        os.close(fd)
+
+def run(pid, spec):
+    try:
+        if spec.get("pty", True):
+            master, slave = pty.openpty()
+            fds = [(master, STDOUT)]
+            p = subprocess.Popen(spec["cmd"], shell = True, stdin = slave, stdout = slave, stderr = slave, start_new_session = True)
+            os.close(slave)
+            stdin, tty = master, True
+        else:
+            p = subprocess.Popen(spec["cmd"], shell = True, stdin = subprocess.PIPE, stdout = subprocess.PIPE, \
+                                 stderr = subprocess.PIPE, start_new_session = True)
+            fds = [(os.dup(p.stdout.fileno()), STDOUT), (os.dup(p.stderr.fileno()), STDERR)]
+            stdin, tty = os.dup(p.stdin.fileno()), False
+            p.stdin.close()
+            p.stdout.close()
+            p.stderr.close()
+    except Exception as e:
+        stdins.pop(pid, None)
+        send(STDERR, pid, str(e).encode("utf-8"))
+        send(EXIT, pid, b"127")
+        return
+
+    threading.Thread(target = feed, args = (pid, stdin, stdins[pid], tty), daemon = True).start()
+    children[pid] = p
+    exited = threading.Event()
+    pumps = [threading.Thread(target = pump, args = (pid, fd, kind, exited)) for fd, kind in fds]
+    for t in pumps:
+        t.start()
+    code = p.wait()
+    exited.set()
+    for t in pumps:
+        t.join()
+    children.pop(pid, None)
+    q = stdins.pop(pid, None)
+    if q is not None:
+        q.put(None)
+    send(EXIT, pid, str(code).encode("utf-8"))
+
+def kill(p, name):
+    try:
+        os.killpg(p.pid, getattr(signal, "SIG" + name))
+    except (OSError, AttributeError):
+        pass
+
+def main():
+    inp = sys.stdin.buffer
+    while True:
+        header = inp.read(HEADER.size)
+        if len(header) < HEADER.size:
+            break
+        kind, pid, length = HEADER.unpack(header)
+        payload = inp.read(length)
+        if kind == SPAWN:
+            # input may follow right away, before the command is started
+            stdins[pid] = queue.Queue()
+            threading.Thread(target = run, args = (pid, json.loads(payload.decode("utf-8"))), daemon = True).start()
+        elif kind == SIGNAL:
+            p = children.get(pid)
+            if p is not None:
+                kill(p, payload.decode("utf-8"))
+        elif kind == STDIN or kind == CLOSE_STDIN:
+            q = stdins.get(pid)
+            if q is not None:
+                q.put(payload if kind == STDIN else None)
+
+    # the controller went away, take the children with us
+    for p in list(children.values()):
+        kill(p, "HUP")
+
+main()
+'''
+
+
+class Agent():
+    """
+    a helper process on the remote that spawns, signals and reaps commands on behalf of the controller
+    all processes share the one ssh channel the agent runs on, so they neither cost a channel open
+    nor count against the MaxSessions limit of the sshd
+    """
+    def __init__(self, remote, interpreter = "python3"):
+        self.remote = remote
+        self.channels = {} # process id -> AgentChannel
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.alive = True
+
+        source = AGENT_SOURCE.encode("utf-8")
+        bootstrap = "import sys;exec(sys.stdin.buffer.read({}))".format(len(source))
+
+        self.chan = remote.ssh.get_transport().open_channel("session")
+        self.chan.exec_command("{} -u -c {}".format(interpreter, shlex.quote(bootstrap)))
+        self.chan.sendall(source)
+
+        self.reader = threading.Thread(target = self._read_frames, name = "jumbonet-agent-{}".format(remote.name), daemon = True)
+        self.reader.start()
+        log.debug("Started agent @ %s via %s" %(remote.name, self.chan))
+
+    def spawn(self, command, pty = True):
+        """start command on the remote, returns a channel-like handle for a Process"""
+        if not self.alive:
+            raise Exception("Agent @ {} is gone".format(self.remote.name))
+
+        pid = next(self.ids)
+        chan = AgentChannel(self, pid)
+        with self.lock:
+            self.channels[pid] = chan
+        self._send(SPAWN, pid, json.dumps({"cmd": command, "pty": pty}).encode("utf-8"))
+        return chan
+
+    def signal(self, pid, name = "HUP"):
+        if self.alive:
+            self._send(SIGNAL, pid, name.encode("utf-8"))
+
+    def forget(self, pid):
+        with self.lock:
+            self.channels.pop(pid, None)
+
+    def close(self):
+        self.alive = False
+        self.chan.close()
+
+    def _send(self, kind, pid, payload):
+        with self.send_lock:
+            self.chan.sendall(HEADER.pack(kind, pid, len(payload)) + payload)
+
+    def _read_frames(self):
+        f = self.chan.makefile("rb")
+        try:
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                kind, pid, length = HEADER.unpack(header)
+                payload = f.read(length)
+
+                with self.lock:
+                    chan = self.channels.get(pid)
+                if chan is None:
+                    # killed on our end already
+                    continue
+
+                if kind == STDOUT:
+                    chan.in_buffer.feed(payload)
+                elif kind == STDERR:
+                    chan.in_stderr_buffer.feed(payload)
+                elif kind == WROTE:
+                    chan._open_window(int(payload))
+                elif kind == EXIT:
+                    self.forget(pid)
+                    chan._set_exited(int(payload))
+        except:
+            traceback.print_exc()
+
+        self.alive = False
+        if self.chan.recv_stderr_ready():
+            log.error("Agent @ {} failed: {}".format(self.remote.name, self.chan.recv_stderr(4096).decode("utf-8", "replace")))
+        log.debug("Agent @ %s exited" %self.remote.name)
+
+        # whatever is still running over there is lost to us
+        with self.lock:
+            orphans = list(self.channels.values())
+            self.channels.clear()
+        for chan in orphans:
+            chan._set_exited(-1)
+
+
+class AgentChannel(vchannel.VirtualChannel):
+    """stands in for the paramiko channel of a Process started through an Agent"""
+    def __init__(self, agent, pid):
+        super().__init__()
+        self.agent = agent
+        self.pid = pid
+        self.timeout = 0
+
+    def __str__(self):
+        return "<jumbonet.agent.AgentChannel {} on {}>".format(self.pid, self.agent.chan)
+
+    def send(self, data):
+        """send as much of data to the stdin of the process as the agent has confirmed room for"""
+        if not self.agent.alive:
+            raise OSError("Socket is closed")
+        n = self._reserve(len(data))
+        self.agent._send(STDIN, self.pid, bytes(data[:n]))
+        return n
+
+    def shutdown_write(self):
+        if not self.closed and self.agent.alive:
+            self.agent._send(CLOSE_STDIN, self.pid, b"")
+
+    def _on_close(self):
+        self.agent.forget(self.pid)
+        self.agent.signal(self.pid)
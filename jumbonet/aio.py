@@ -0,0 +1,237 @@
+import asyncio
+import functools
+import logging
+from . import master
+
+log = logging.getLogger(__name__)
+
+
+class AsyncMaster():
+    """
+    an asyncio front end to Master/Remote/Process
+    instead of running the threaded mainloop, the channels of all processes are watched by the event loop
+
+        net = aio.AsyncMaster()
+        h1 = await net.connect("h1", "20.0.0.1", "username", keyfile = "~/.ssh/id_rsa")
+        ping = await h1.start(["ping", "-c", "3", "10.0.0.2"])
+        async for line in ping.stdout:
+            print(line)
+        exitcode = await ping.wait()
+        await net.shutdown()
+
+    handshakes and channel opens are blocking round trips and run in the loop's default executor
+    """
+    def __init__(self, default_keyfile = None, default_user = None, default_inband_interface = "eth0"):
+        self.net = master.Master(default_keyfile = default_keyfile, default_user = default_user, \
+                                 default_inband_interface = default_inband_interface)
+        self.loop = None
+        self.remotes = {} # name -> AsyncRemote
+        self.watched = {} # process -> fd
+        self.exit_polls = {} # process at eof -> the next poll interval
+
+    def _attach(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is None:
+            self.loop = loop
+        assert(self.loop is loop)
+        return loop
+
+    def _adopt(self, r):
+        # processes started, queued or killed from other threads make the loop resync
+        r.wakeup = self._wakeup
+        ar = AsyncRemote(self, r)
+        self.remotes[r.name] = ar
+        return ar
+
+    async def connect(self, name, host, user, **kwargs):
+        """connect a remote, takes the keyword arguments of Master.add_remote"""
+        loop = self._attach()
+        r = await loop.run_in_executor(None, functools.partial(self.net.add_remote, name, host, user, **kwargs))
+        return self._adopt(r)
+
+    async def connect_many(self, specs, **kwargs):
+        """connect many remotes concurrently, see Master.add_remotes"""
+        loop = self._attach()
+        try:
+            remotes = await loop.run_in_executor(None, functools.partial(self.net.add_remotes, specs, **kwargs))
+        except master.ConnectError as e:
+            for r in e.remotes:
+                self._adopt(r)
+            raise
+        return [self._adopt(r) for r in remotes]
+
+    async def shutdown(self):
+        for p in list(self.watched):
+            self._unwatch(p)
+        await self._attach().run_in_executor(None, self.net.shutdown)
+
+    def _wakeup(self):
+        if self.loop is None:
+            return
+        try:
+            self.loop.call_soon_threadsafe(self._sync)
+        except RuntimeError:
+            # the loop is closed
+            pass
+
+    def _sync(self):
+        """start watching new channels and settle processes that will not become readable anymore"""
+        for ar in list(self.remotes.values()):
+            r = ar.remote
+            for p in list(r.live):
+                if p.exitcode is not None or p in self.exit_polls:
+                    # or polled for its exit status already
+                    continue
+
+                if p in self.watched:
+                    # a killed channel closes its pipe, which silently drops out of the selector
+                    if p.chan.closed:
+                        self._ready(r, p)
+                    continue
+
+                if p.chan is None:
+                    if p.cancelled:
+                        self._ready(r, p)
+                    continue
+
+                if p.chan.closed or p.chan.eof_received:
+                    self._ready(r, p)
+                    continue
+
+                fd = p.chan.fileno()
+                self.loop.add_reader(fd, self._ready, r, p)
+                self.watched[p] = fd
+                # data may have arrived before we started watching
+                self._ready(r, p)
+
+    def _unwatch(self, p):
+        fd = self.watched.pop(p, None)
+        if fd is not None:
+            try:
+                self.loop.remove_reader(fd)
+            except (ValueError, OSError):
+                pass
+
+    def _ready(self, r, p):
+        r.check_process(p)
+
+        if p.exitcode is not None:
+            self._unwatch(p)
+            self.exit_polls.pop(p, None)
+        elif p.chan is not None and (p.chan.closed or p.chan.eof_received):
+            # the pipe of a channel at eof stays readable, poll for the exit status instead, less often the longer it takes
+            self._unwatch(p)
+            interval = self.exit_polls.get(p, master.EXIT_TIMEOUT)
+            self.exit_polls[p] = min(interval * 2, master.EXIT_BACKOFF)
+            self.loop.call_later(interval, self._ready, r, p)
+
+
+class AsyncRemote():
+    def __init__(self, net, remote):
+        self.net = net
+        self.remote = remote
+        self.name = remote.name
+
+    def __getattr__(self, name):
+        # IP(), MAC(), launch_stats() etc. of the wrapped remote
+        return getattr(self.remote, name)
+
+    async def start(self, args, listener = None, **kwargs):
+        """
+        start a process, takes the keyword arguments of Remote.popen
+        :param listener an optional Subscriber that receives the callbacks in addition
+        """
+        loop = self.net._attach()
+        relay = Relay(loop, listener)
+        p = await loop.run_in_executor(None, functools.partial(self.remote.popen, args, relay, \
+                                                               listen_output = True, listen_error = True, listen_status = True, **kwargs))
+        ap = AsyncProcess(p, relay)
+        self.net._sync()
+        return ap
+
+
+class Relay(master.Subscriber):
+    """
+    turns the callbacks of a Process into the streams and the exit future of an AsyncProcess
+    exists before the process is started, so nothing is lost if output arrives before start() returns
+    """
+    def __init__(self, loop, listener = None):
+        self.listener = listener
+        self.stdout = LineStream()
+        self.stderr = LineStream()
+        self.exit = loop.create_future()
+
+    def receive_out(self, remotename, uuid, args, lines):
+        self.stdout._feed(lines)
+        if self.listener is not None:
+            self.listener.receive_out(remotename, uuid, args, lines)
+
+    def receive_err(self, remotename, uuid, args, lines):
+        self.stderr._feed(lines)
+        if self.listener is not None:
+            self.listener.receive_err(remotename, uuid, args, lines)
+
+    def receive_status(self, remotename, uuid, args, exitcode):
+        self.stdout._close()
+        self.stderr._close()
+        if not self.exit.done():
+            self.exit.set_result(exitcode)
+        if self.listener is not None:
+            self.listener.receive_status(remotename, uuid, args, exitcode)
+
+
+class AsyncProcess():
+    def __init__(self, process, relay):
+        self.process = process
+        self.uuid = process.uuid
+        self.args = process.args
+        self.stdout = relay.stdout
+        self.stderr = relay.stderr
+        self.exit = relay.exit
+
+    def __str__(self):
+        return "Async{}".format(self.process)
+
+    @property
+    def exitcode(self):
+        return self.process.exitcode
+
+    def kill(self):
+        self.process.kill()
+
+    async def wait(self):
+        """returns the exitcode"""
+        return await asyncio.shield(self.exit)
+
+
+class LineStream():
+    """the lines of one stream of a process, as they arrive, iterate with async for"""
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.closed = False
+
+    def _feed(self, lines):
+        for line in lines:
+            self.queue.put_nowait(line)
+
+    def _close(self):
+        if not self.closed:
+            self.closed = True
+            self.queue.put_nowait(None)
+
+    async def readline(self):
+        """the next line or None once the process has exited"""
+        line = await self.queue.get()
+        if line is None:
+            # let every other reader see the end as well
+            self.queue.put_nowait(None)
+        return line
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        line = await self.readline()
+        if line is None:
+            raise StopAsyncIteration
+        return line
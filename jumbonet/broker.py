@@ -0,0 +1,577 @@
+import argparse
+import hashlib
+import itertools
+import json
+import logging
+import os
+import queue
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from paramiko import SSHClient, AutoAddPolicy, SFTPClient
+from paramiko.ssh_exception import SSHException, ChannelException
+from . import vchannel
+
+log = logging.getLogger(__name__)
+
+# keeps authenticated ssh transports to the testbed hosts alive between runs, in the spirit of an openssh ControlMaster
+# start it once with
+#   python -m jumbonet.broker [--socket PATH] [--idle SECONDS]
+# and connect remotes through it with Master(broker = True), add_remote(..., broker = True) or Testcase(broker = True)
+# connecting a host the broker already knows then takes a local round trip instead of a tcp, kex and auth handshake
+#
+# every Remote gets a connection of its own to the unix socket, carrying frames of kind, channel id, payload length
+HEADER = struct.Struct("!BII")
+EXIT_STATUS = struct.Struct("!i")
+# remote -> broker
+HELLO = 0 # json connection parameters, answered with a HELLO json {"ok", "error", "cached"}
+OPEN = 1 # json {"pty", "command", "subsystem"}, answered with OPENED json {"ok", "error", "refused"}
+DATA = 2
+EOF = 3
+CLOSE = 4
+# broker -> remote
+OPENED = 5
+STDOUT = 6
+STDERR = 7
+EXIT = 8 # the exit status, the channel is gone on both ends afterwards
+WROTE = 9 # "!I" bytes of DATA written to the channel (or dropped), opens the window of the remote again
+WRITTEN = struct.Struct("!I")
+
+DEFAULT_SOCKET = os.path.join("~", ".jumbonet", "broker.sock")
+DEFAULT_IDLE = 600 # seconds an unused transport is kept open
+BUFFSIZE = 32768
+IDLE_TIMEOUT = 1.0
+START_TIMEOUT = 5
+
+
+def socket_path(path = None):
+    return os.path.expanduser(DEFAULT_SOCKET if path is None or path is True else path)
+
+
+def _listening(path):
+    """whether a broker accepts connections on path, a socket file alone may be left over from a crash"""
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        probe.close()
+
+
+def start_daemon(path = None, idle = DEFAULT_IDLE):
+    """start a broker in the background unless one is already listening on path"""
+    path = socket_path(path)
+    if _listening(path):
+        return
+
+    if os.path.exists(path):
+        log.info("Removing the stale broker socket {}".format(path))
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    log.info("Starting a jumbonet broker on {}".format(path))
+    subprocess.Popen([sys.executable, "-m", "jumbonet.broker", "--socket", path, "--idle", str(idle)], \
+                     stdin = subprocess.DEVNULL, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL, \
+                     start_new_session = True, close_fds = True)
+
+    deadline = time.monotonic() + START_TIMEOUT
+    while time.monotonic() < deadline:
+        if _listening(path):
+            return
+        time.sleep(0.02)
+    raise Exception("The jumbonet broker did not come up on {}".format(path))
+
+
+def _send(sock, lock, kind, cid, payload):
+    with lock:
+        sock.sendall(HEADER.pack(kind, cid, len(payload)) + payload)
+
+
+def _recv_exactly(f, n):
+    data = f.read(n)
+    if len(data) < n:
+        raise EOFError()
+    return data
+
+
+class Broker():
+    """
+    the daemon side, owns the SSHClients and relays the channels opened on them to the connected remotes
+    transports are shared by every remote connecting to the same host with the same credentials
+    """
+    def __init__(self, path = None, idle = DEFAULT_IDLE):
+        self.path = socket_path(path)
+        self.idle = idle
+        self.clients = {} # (host, port, user, keyfile, password digest) -> SSHClient
+        self.last_used = {} # same key -> monotonic time the last connection using it went away
+        self.users = {} # same key -> number of connected remotes using it
+        self.connecting = {} # same key -> Lock held while connecting it, so concurrent HELLOs share one client
+        self.lock = threading.Lock()
+        self.run = False
+        self.sock = None
+
+    def serve_forever(self):
+        directory = os.path.dirname(self.path)
+        if len(directory) > 0:
+            os.makedirs(directory, mode = 0o700, exist_ok = True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # whoever can connect can use the cached logins
+        old = os.umask(0o177)
+        try:
+            self.sock.bind(self.path)
+        finally:
+            os.umask(old)
+        self.sock.listen(128)
+        self.run = True
+
+        threading.Thread(target = self._expire, name = "jumbonet-broker-expire", daemon = True).start()
+        log.info("jumbonet broker listening on {}".format(self.path))
+
+        try:
+            while self.run:
+                try:
+                    conn, _ = self.sock.accept()
+                except OSError:
+                    break
+                threading.Thread(target = BrokerSession(self, conn).serve, name = "jumbonet-broker-session", \
+                                 daemon = True).start()
+        finally:
+            self.close()
+
+    def close(self):
+        self.run = False
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+        with self.lock:
+            clients = list(self.clients.values())
+            self.clients.clear()
+        for client in clients:
+            client.close()
+
+    def acquire(self, params):
+        """the SSHClient for params, connecting it first unless a live one is cached, returns (key, client, cached)"""
+        password = params.get("password")
+        digest = None if password is None else hashlib.sha256(password.encode("utf-8")).hexdigest()
+        key = (params["host"], params.get("port", 22), params["user"], params.get("keyfile"), digest)
+
+        with self.lock:
+            self.users[key] = self.users.get(key, 0) + 1
+            connecting = self.connecting.setdefault(key, threading.Lock())
+
+        with connecting:
+            with self.lock:
+                client = self.clients.get(key)
+            transport = None if client is None else client.get_transport()
+            if transport is not None and transport.is_active():
+                return key, client, True
+
+            timeout = params.get("timeout")
+            client = SSHClient()
+            client.set_missing_host_key_policy(AutoAddPolicy())
+            try:
+                client.connect(key[0], key[1], key[2], password, key_filename = key[3], look_for_keys = True, \
+                               timeout = timeout, banner_timeout = timeout, auth_timeout = timeout)
+            except:
+                self.release(key)
+                raise
+            client.get_transport().set_keepalive(1)
+
+            # a cached client is only replaced once its transport died
+            with self.lock:
+                stale = self.clients.get(key)
+                self.clients[key] = client
+        if stale is not None:
+            stale.close()
+        log.info("Connected {}@{}:{}".format(key[2], key[0], key[1]))
+        return key, client, False
+
+    def release(self, key):
+        with self.lock:
+            self.users[key] -= 1
+            self.last_used[key] = time.monotonic()
+
+    def _expire(self):
+        while self.run:
+            time.sleep(min(self.idle, 10))
+            now = time.monotonic()
+            with self.lock:
+                expired = [key for key in self.clients \
+                           if self.users.get(key, 0) == 0 and now - self.last_used.get(key, now) > self.idle]
+                clients = [self.clients.pop(key) for key in expired]
+            for key, client in zip(expired, clients):
+                log.info("Closing idle {}@{}:{}".format(key[2], key[0], key[1]))
+                client.close()
+
+
+class BrokerSession():
+    """the channels one Remote has open through the broker"""
+    def __init__(self, broker, conn):
+        self.broker = broker
+        self.conn = conn
+        self.send_lock = threading.Lock()
+        self.key = None
+        self.client = None
+        self.channels = {} # channel id -> paramiko channel
+        self.stdins = {} # channel id -> Queue of the thread writing to it, (kind, payload) or None to stop
+        self.lock = threading.Lock()
+
+    def serve(self):
+        f = self.conn.makefile("rb")
+        try:
+            while True:
+                kind, cid, length = HEADER.unpack(_recv_exactly(f, HEADER.size))
+                payload = _recv_exactly(f, length)
+
+                if kind == HELLO:
+                    self._hello(json.loads(payload.decode("utf-8")))
+                elif kind == OPEN:
+                    self._open(cid, json.loads(payload.decode("utf-8")))
+                else:
+                    with self.lock:
+                        chan = self.channels.get(cid)
+                        stdin = self.stdins.get(cid)
+                    if chan is None:
+                        continue
+                    if kind == DATA or kind == EOF:
+                        # a command that does not read its stdin only holds up its own writer
+                        stdin.put((kind, payload))
+                    elif kind == CLOSE:
+                        chan.close()
+                        stdin.put(None)
+        except (EOFError, OSError):
+            pass
+        except:
+            traceback.print_exc()
+
+        # the remote disconnected, which ends its processes just like closing its own transport would
+        with self.lock:
+            channels = list(self.channels.values())
+            self.channels.clear()
+            stdins = list(self.stdins.values())
+            self.stdins.clear()
+        for chan in channels:
+            chan.close()
+        for stdin in stdins:
+            stdin.put(None)
+        if self.key is not None:
+            self.broker.release(self.key)
+        self.conn.close()
+
+    def _reply(self, kind, cid, answer):
+        _send(self.conn, self.send_lock, kind, cid, json.dumps(answer).encode("utf-8"))
+
+    def _hello(self, params):
+        try:
+            self.key, self.client, cached = self.broker.acquire(params)
+            self._reply(HELLO, 0, {"ok": True, "cached": cached})
+        except Exception as e:
+            self._reply(HELLO, 0, {"ok": False, "error": "{}: {}".format(type(e).__name__, e)})
+
+    def _open(self, cid, request):
+        try:
+            chan = self.client.get_transport().open_channel("session")
+        except (ChannelException, SSHException) as e:
+            self._reply(OPENED, cid, {"ok": False, "error": str(e), "refused": isinstance(e, ChannelException)})
+            return
+
+        try:
+            if request.get("pty"):
+                chan.get_pty()
+            if request.get("subsystem") is not None:
+                chan.invoke_subsystem(request["subsystem"])
+            else:
+                chan.exec_command(request["command"])
+        except SSHException as e:
+            chan.close()
+            self._reply(OPENED, cid, {"ok": False, "error": str(e), "refused": False})
+            return
+
+        stdin = queue.Queue()
+        with self.lock:
+            self.channels[cid] = chan
+            self.stdins[cid] = stdin
+        self._reply(OPENED, cid, {"ok": True})
+        threading.Thread(target = self._pump, args = (cid, chan), name = "jumbonet-broker-{}".format(cid), \
+                         daemon = True).start()
+        threading.Thread(target = self._feed, args = (cid, chan, stdin), name = "jumbonet-broker-stdin-{}".format(cid), \
+                         daemon = True).start()
+
+    def _feed(self, cid, chan, stdin):
+        """write what the remote sends for the stdin of one channel, a failed write only ends that channel"""
+        failed = False
+        while True:
+            item = stdin.get()
+            if item is None:
+                break
+            kind, payload = item
+            if not failed:
+                try:
+                    if kind == DATA:
+                        chan.sendall(payload)
+                    else:
+                        chan.shutdown_write()
+                except (OSError, SSHException) as e:
+                    log.debug("Dropping the stdin of channel {}: {}".format(cid, e))
+                    failed = True
+                    # the pump sends its exit status once it is closed
+                    chan.close()
+            if kind == DATA:
+                # written or dropped, either way the remote may send more
+                try:
+                    _send(self.conn, self.send_lock, WROTE, cid, WRITTEN.pack(len(payload)))
+                except OSError:
+                    pass
+
+    def _pump(self, cid, chan):
+        """relay the output and the exit status of one channel"""
+        selector = selectors.DefaultSelector()
+        selector.register(chan, selectors.EVENT_READ)
+        try:
+            while True:
+                if chan.recv_ready():
+                    _send(self.conn, self.send_lock, STDOUT, cid, chan.recv(BUFFSIZE))
+                elif chan.recv_stderr_ready():
+                    _send(self.conn, self.send_lock, STDERR, cid, chan.recv_stderr(BUFFSIZE))
+                elif chan.closed or chan.eof_received:
+                    break
+                else:
+                    selector.select(IDLE_TIMEOUT)
+
+            exitcode = chan.recv_exit_status()
+            _send(self.conn, self.send_lock, EXIT, cid, EXIT_STATUS.pack(exitcode))
+        except OSError:
+            pass
+        finally:
+            selector.close()
+
+        with self.lock:
+            self.channels.pop(cid, None)
+            stdin = self.stdins.pop(cid, None)
+        if stdin is not None:
+            stdin.put(None)
+        chan.close()
+
+
+class BrokerClient():
+    """
+    stands in for the SSHClient of a Remote connected through a broker
+    implements what Remote, Agent, deploy and Local.collect use of SSHClient and Transport
+    """
+    def __init__(self, path = None, autostart = True):
+        self.path = socket_path(path)
+        self.autostart = autostart
+        self.sock = None
+        self.send_lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.channels = {} # channel id -> BrokerChannel
+        self.lock = threading.Lock()
+        self.hello = None
+        self.replied = threading.Event()
+        self.cached = False
+        self.active = False
+
+    def set_missing_host_key_policy(self, policy):
+        # host keys are the broker's business
+        pass
+
+    def connect(self, hostname, port = 22, username = None, password = None, key_filename = None, timeout = None, **kwargs):
+        if self.autostart:
+            start_daemon(self.path)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+        self.active = True
+        threading.Thread(target = self._read_frames, name = "jumbonet-broker-{}".format(hostname), daemon = True).start()
+
+        if key_filename is not None:
+            key_filename = os.path.abspath(os.path.expanduser(key_filename))
+        params = {"host": hostname, "port": port, "user": username, "password": password, "keyfile": key_filename, \
+                  "timeout": timeout}
+        _send(self.sock, self.send_lock, HELLO, 0, json.dumps(params).encode("utf-8"))
+
+        if not self.replied.wait(timeout) or self.hello is None:
+            self.close()
+            raise SSHException("No answer from the jumbonet broker on {}".format(self.path))
+        if not self.hello["ok"]:
+            self.close()
+            raise SSHException(self.hello["error"])
+        self.cached = self.hello["cached"]
+        log.debug("Attached to {}:{} via the broker{}".format(hostname, port, " (cached)" if self.cached else ""))
+
+    def get_transport(self):
+        return self
+
+    def is_active(self):
+        return self.active
+
+    def set_keepalive(self, interval):
+        # the broker keeps its transports alive
+        pass
+
+    def open_channel(self, kind = "session"):
+        assert(kind == "session")
+        if not self.active:
+            raise SSHException("Not connected to the jumbonet broker")
+        cid = next(self.ids)
+        chan = BrokerChannel(self, cid)
+        with self.lock:
+            self.channels[cid] = chan
+        return chan
+
+    def open_session(self):
+        return self.open_channel("session")
+
+    def open_sftp(self):
+        chan = self.open_channel("session")
+        chan.invoke_subsystem("sftp")
+        return SFTPClient(chan)
+
+    def close(self):
+        self.active = False
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+
+    def forget(self, cid):
+        with self.lock:
+            self.channels.pop(cid, None)
+
+    def _send(self, kind, cid, payload = b""):
+        _send(self.sock, self.send_lock, kind, cid, payload)
+
+    def _read_frames(self):
+        f = self.sock.makefile("rb")
+        try:
+            while True:
+                kind, cid, length = HEADER.unpack(_recv_exactly(f, HEADER.size))
+                payload = _recv_exactly(f, length)
+
+                if kind == HELLO:
+                    self.hello = json.loads(payload.decode("utf-8"))
+                    self.replied.set()
+                    continue
+
+                with self.lock:
+                    chan = self.channels.get(cid)
+                if chan is None:
+                    continue
+
+                if kind == OPENED:
+                    chan.opened = json.loads(payload.decode("utf-8"))
+                    chan.replied.set()
+                elif kind == STDOUT:
+                    chan.in_buffer.feed(payload)
+                elif kind == STDERR:
+                    chan.in_stderr_buffer.feed(payload)
+                elif kind == WROTE:
+                    chan._open_window(WRITTEN.unpack(payload)[0])
+                elif kind == EXIT:
+                    self.forget(cid)
+                    chan._set_exited(EXIT_STATUS.unpack(payload)[0])
+        except (EOFError, OSError):
+            pass
+        except:
+            traceback.print_exc()
+
+        self.active = False
+        self.replied.set()
+        with self.lock:
+            orphans = list(self.channels.values())
+            self.channels.clear()
+        for chan in orphans:
+            chan.replied.set()
+            chan.close()
+
+
+class BrokerChannel(vchannel.VirtualChannel):
+    """stands in for a paramiko channel opened through the broker"""
+    def __init__(self, client, cid):
+        super().__init__()
+        self.client = client
+        self.cid = cid
+        self.pty = False
+        self.opened = None
+        self.replied = threading.Event()
+
+    def __str__(self):
+        return "<jumbonet.broker.BrokerChannel {}>".format(self.cid)
+
+    def get_pty(self, *args, **kwargs):
+        # sent along with the command
+        self.pty = True
+
+    def exec_command(self, command):
+        self._open({"pty": self.pty, "command": command})
+
+    def invoke_subsystem(self, subsystem):
+        self._open({"pty": self.pty, "subsystem": subsystem})
+
+    def _open(self, request):
+        self.client._send(OPEN, self.cid, json.dumps(request).encode("utf-8"))
+        self.replied.wait()
+        if self.opened is None:
+            raise SSHException("Lost the jumbonet broker")
+        if not self.opened["ok"]:
+            self.client.forget(self.cid)
+            self.closed = True
+            if self.opened["refused"]:
+                raise ChannelException(1, self.opened["error"])
+            raise SSHException(self.opened["error"])
+
+    def send(self, data):
+        """send as much of data as the broker has confirmed room for"""
+        if not self.client.active:
+            raise OSError("Socket is closed")
+        n = self._reserve(len(data))
+        self.client._send(DATA, self.cid, bytes(data[:n]))
+        return n
+
+    def shutdown_write(self):
+        self.client._send(EOF, self.cid)
+
+    def _on_close(self):
+        self.client.forget(self.cid)
+        if self.client.active and self.opened is not None:
+            try:
+                self.client._send(CLOSE, self.cid)
+            except OSError:
+                pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "keeps ssh connections for jumbonet alive between runs")
+    parser.add_argument("--socket", default = None, help = "unix socket to listen on, default {}".format(DEFAULT_SOCKET))
+    parser.add_argument("--idle", type = float, default = DEFAULT_IDLE, \
+                        help = "seconds an unused connection is kept open, default {}".format(DEFAULT_IDLE))
+    parser.add_argument("-v", "--verbose", action = "store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.DEBUG if args.verbose else logging.INFO)
+    broker = Broker(args.socket, idle = args.idle)
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        broker.close()
+
+
+if __name__ == "__main__":
+    main()
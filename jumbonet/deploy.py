@@ -0,0 +1,112 @@
+import hashlib
+import logging
+import os
+import posixpath
+import shlex
+import stat
+import time
+import uuid
+
+log = logging.getLogger(__name__)
+
+HASH_CHUNK = 1 << 20
+
+
+def local_files(local_paths):
+    """
+    expand files and directories into (local path, path relative to the target directory)
+    directories keep their name, i.e. tools/ ends up as <remote_dir>/tools/...
+    """
+    files = []
+    for path in local_paths:
+        path = os.path.expanduser(path).rstrip(os.sep)
+        if os.path.isdir(path):
+            base = os.path.dirname(path)
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                for name in sorted(names):
+                    full = os.path.join(root, name)
+                    files.append((full, os.path.relpath(full, base).replace(os.sep, "/")))
+        elif os.path.isfile(path):
+            files.append((path, os.path.basename(path)))
+        else:
+            raise Exception("Nothing to deploy at {}".format(path))
+    return files
+
+
+def sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(HASH_CHUNK)
+            if len(chunk) == 0:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def remote_hashes(remote, remote_dir, names):
+    """
+    the sha256 of every file in names that already exists under remote_dir, in a single round trip
+    also creates remote_dir and the subdirectories the files go to
+    without sha256sum or shasum on the remote nothing counts as existing, i.e. everything is uploaded
+    """
+    dirs = sorted(set([remote_dir] + [posixpath.join(remote_dir, posixpath.dirname(n)) for n in names if "/" in n]))
+    # exits 2 if the directories cannot be prepared, sha256sum exits 1 for the files that do not exist yet
+    command = "{{ mkdir -p {} && cd {}; }} || exit 2; ".format(" ".join(shlex.quote(d) for d in dirs), shlex.quote(remote_dir)) + \
+              "if command -v sha256sum >/dev/null; then H=sha256sum; " + \
+              "elif command -v shasum >/dev/null; then H='shasum -a 256'; else exit 0; fi; " + \
+              "$H -- {} 2>/dev/null; [ $? -le 1 ]".format(" ".join(shlex.quote(n) for n in names))
+
+    chan = remote.ssh.get_transport().open_session()
+    try:
+        chan.exec_command(command)
+        answer = chan.makefile("rb").read().decode("utf-8")
+        status = chan.recv_exit_status()
+        if status == 2:
+            raise Exception("Could not prepare {} on {}: {}".format(remote_dir, remote.name, \
+                            chan.recv_stderr(4096).decode("utf-8", "replace").strip()))
+        if status != 0:
+            raise Exception("Could not hash the files in {} on {} ({})".format(remote_dir, remote.name, status))
+    finally:
+        chan.close()
+
+    hashes = {}
+    for line in answer.splitlines():
+        digest, _, name = line.partition(" ")
+        # sha256sum marks binary mode with a leading *
+        hashes[name.strip().lstrip("*")] = digest
+    return hashes
+
+
+def deploy_remote(remote, files, remote_dir):
+    """
+    upload the files whose content differs on remote
+    :param files [(local path, relative name, sha256)]
+    """
+    start = time.monotonic()
+    have = remote_hashes(remote, remote_dir, [name for _, name, _ in files])
+    changed = [(path, name) for path, name, digest in files if have.get(name) != digest]
+
+    uploaded = 0
+    if len(changed) > 0:
+        sftp = remote.ssh.open_sftp()
+        try:
+            for path, name in changed:
+                target = posixpath.join(remote_dir, name)
+                # upload next to the target and swap it in, so a running tool never sees a half written file
+                # the name is unique to this upload, remotes may share the directory (e.g. an nfs home)
+                partial = "{}.jumbonet-{}".format(target, uuid.uuid4().hex)
+                sftp.put(path, partial)
+                sftp.chmod(partial, stat.S_IMODE(os.stat(path).st_mode))
+                sftp.posix_rename(partial, target)
+                uploaded += os.path.getsize(path)
+                log.debug("-- {} -> {}:{}".format(path, remote.name, target))
+        finally:
+            sftp.close()
+
+    elapsed = time.monotonic() - start
+    log.info("Deployed to {}: {} of {} files changed, {:.1f} MB in {:.2f}s".format(remote.name, len(changed), len(files), \
+             uploaded / 1e6, elapsed))
+    return {"uploaded": [name for _, name in changed], "unchanged": len(files) - len(changed), "bytes": uploaded, \
+            "seconds": elapsed}
@@ -0,0 +1,153 @@
+import collections
+import logging
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+import traceback
+from . import metrics
+from . import trace
+
+log = logging.getLogger(__name__)
+
+# what to do once a process has maxsize events waiting for its listeners
+BLOCK = "block" # make the mainloop wait, nothing is lost
+DROP_OLDEST = "drop_oldest" # discard the oldest output, exit statuses are always delivered
+COALESCE = "coalesce" # merge new output into the newest pending event, listeners get bigger batches
+
+
+class Dispatcher():
+    """
+    hands the output and status events of processes to their listeners on a pool of worker threads
+    so a slow listener no longer holds up reading the channels of every other process
+    events of one process are delivered in order and never by two workers at the same time
+
+        net = master.Master(dispatcher = dispatch.Dispatcher(workers = 4, overflow = dispatch.COALESCE))
+    """
+    def __init__(self, workers = 4, maxsize = 1024, overflow = BLOCK):
+        assert(overflow in (BLOCK, DROP_OLDEST, COALESCE))
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.pool = ThreadPool(processes = workers)
+        self.queues = {} # process uuid -> EventQueue
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+
+    def submit(self, remotename, process, out, err, exited, exitcode):
+        """queue what one read of process produced, called by Remote.check_process"""
+        with self.lock:
+            q = self.queues.get(process.uuid)
+            if q is None:
+                q = EventQueue(remotename, process)
+                self.queues[process.uuid] = q
+
+        event = [time.monotonic(), out, err, exited, exitcode]
+
+        with q.cond:
+            while len(q.events) >= self.maxsize and not exited:
+                if self.overflow == BLOCK:
+                    q.cond.wait()
+                    continue
+
+                if self.overflow == COALESCE:
+                    last = q.events[-1]
+                    last[1] = last[1] + out
+                    last[2] = last[2] + err
+                    q.coalesced += 1
+                    return
+
+                dropped = q.events.popleft()
+                q.dropped += len(dropped[1]) + len(dropped[2])
+
+            q.events.append(event)
+            if q.scheduled:
+                return
+            q.scheduled = True
+
+        self.pool.apply_async(self._drain, (q,))
+
+    def _drain(self, q):
+        while True:
+            with q.cond:
+                if len(q.events) == 0:
+                    q.scheduled = False
+                    break
+                queued_at, out, err, exited, exitcode = q.events.popleft()
+                q.cond.notify_all()
+
+            with metrics.LISTENER.time(q.remotename):
+                q.deliver(out, err, exited, exitcode)
+            q.delivered += 1
+
+            if exited:
+                trace.record(trace.DELIVERED, q.process, exitcode)
+                with self.lock:
+                    self.queues.pop(q.process.uuid, None)
+
+        with self.lock:
+            self.idle.notify_all()
+
+    def lag(self):
+        """uuid -> (events pending, seconds the oldest of them has been waiting, lines dropped)"""
+        now = time.monotonic()
+        with self.lock:
+            queues = list(self.queues.values())
+
+        stats = {}
+        for q in queues:
+            with q.cond:
+                oldest = now - q.events[0][0] if len(q.events) > 0 else 0.0
+                stats[q.process.uuid] = (len(q.events), oldest, q.dropped)
+        return stats
+
+    def listener_lag(self):
+        """listener -> seconds it is behind on the process it is furthest behind on"""
+        with self.lock:
+            queues = list(self.queues.values())
+        stats = self.lag()
+
+        lags = {}
+        for q in queues:
+            oldest = stats.get(q.process.uuid, (0, 0.0, 0))[1]
+            for listener, _, _, _ in q.process.listeners:
+                lags[listener] = max(lags.get(listener, 0.0), oldest)
+        return lags
+
+    def join(self, timeout = None):
+        """wait until every queued event has been delivered, returns False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            while any(q.scheduled for q in self.queues.values()):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.idle.wait(remaining)
+        return True
+
+    def close(self):
+        self.pool.close()
+
+
+class EventQueue():
+    """the events of one process that still have to be delivered"""
+    def __init__(self, remotename, process):
+        self.remotename = remotename
+        self.process = process
+        self.events = collections.deque()
+        self.cond = threading.Condition()
+        self.scheduled = False
+        self.delivered = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def deliver(self, out, err, exited, exitcode):
+        p = self.process
+        for listener, wants_output, wants_error, wants_status in p.listeners:
+            try:
+                if wants_output and len(out) > 0:
+                    listener.receive_out(self.remotename, p.uuid, p.args, out)
+                if wants_error and len(err) > 0:
+                    listener.receive_err(self.remotename, p.uuid, p.args, err)
+                if wants_status and exited:
+                    listener.receive_status(self.remotename, p.uuid, p.args, exitcode)
+            except:
+                traceback.print_exc()
@@ -0,0 +1,210 @@
+import json
+import logging
+import re
+import shlex
+
+log = logging.getLogger(__name__)
+
+# line filters that run on the remote, so only the lines that are kept cross the ssh connection
+# popen takes a list of steps which are applied in order, e.g.
+#   remote.popen(["ping", "10.0.0.2"], self, filters = [filters.grep("icmp_seq"), filters.every(10)])
+#   remote.popen(["ping", "10.0.0.2"], self, filters = [filters.aggregate(r"time=([0-9.]+)", interval = 1.0)])
+# the command is wrapped in a small python3 helper, which requires a python3 interpreter on the remote
+# and keeps the exitcode of the command, stdout (and on a pty stderr, which the pty merges into it) is filtered
+
+
+def grep(pattern, invert = False):
+    """keep the lines matching the python regex pattern, or those not matching it"""
+    re.compile(pattern)
+    return {"op": "grep", "pattern": pattern, "invert": invert}
+
+
+def every(n):
+    """keep the first and then every nth line"""
+    assert(n >= 1)
+    return {"op": "every", "n": n}
+
+
+def tail(n):
+    """keep only the last n lines, which arrive once the command exited"""
+    assert(n >= 0)
+    return {"op": "tail", "n": n}
+
+
+def aggregate(pattern, interval = None):
+    """
+    instead of the lines, count, sum, min, max and mean of the number the pattern finds in them
+    the number is the first group of pattern, or its whole match if it has none
+    a summary line covering the lines since the last one is sent every interval seconds, and once the command
+    exited if any lines are left or none was sent yet, see parse_aggregate
+    steps after aggregate only see the summary lines
+    """
+    re.compile(pattern)
+    return {"op": "aggregate", "pattern": pattern, "interval": interval}
+
+
+AGGREGATE_PREFIX = "jumbonet-aggregate"
+AGGREGATE_LINE = re.compile(AGGREGATE_PREFIX + r" count=(\d+) sum=(\S+) min=(\S+) max=(\S+) mean=(\S+)")
+
+
+def parse_aggregate(line):
+    """the dict behind a summary line of aggregate, None for any other line"""
+    match = AGGREGATE_LINE.match(line)
+    if match is None:
+        return None
+    count, total, low, high, mean = match.groups()
+    return {"count": int(count), "sum": float(total), "min": float(low), "max": float(high), "mean": float(mean)}
+
+
+def wrap(command, steps, interpreter = "python3"):
+    """the command, run through the filter helper applying steps"""
+    for step in steps:
+        assert(step["op"] in ("grep", "every", "tail", "aggregate"))
+    return "{} -c {} {} {}".format(interpreter, shlex.quote(FILTER_SOURCE), shlex.quote(json.dumps(steps)), \
+                                   shlex.quote(command))
+
+
+# runs the command and filters its stdout, it must stay self-contained and python3 only
+# on a tty the command gets a pty of its own, so it keeps line buffering its output
+FILTER_SOURCE = r'''
+import json, os, re, select, signal, subprocess, sys, time
+
+steps = json.loads(sys.argv[1])
+tty = os.isatty(1)
+if tty:
+    import pty, tty as ttymod
+    master, slave = pty.openpty()
+    ttymod.setraw(slave)
+    child = subprocess.Popen(["/bin/sh", "-c", sys.argv[2]], stdout = slave, stderr = slave, start_new_session = True)
+    os.close(slave)
+    src = master
+else:
+    child = subprocess.Popen(["/bin/sh", "-c", sys.argv[2]], stdout = subprocess.PIPE, start_new_session = True)
+    src = child.stdout.fileno()
+
+def forward(signum, frame):
+    try:
+        os.killpg(child.pid, signum)
+    except OSError:
+        pass
+for s in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM):
+    signal.signal(s, forward)
+
+class Grep:
+    def __init__(self, step):
+        self.pattern = re.compile(step["pattern"].encode())
+        self.invert = step["invert"]
+    def __call__(self, lines):
+        return [l for l in lines if (self.pattern.search(l) is None) == self.invert]
+
+class Every:
+    def __init__(self, step):
+        self.n = step["n"]
+        self.seen = 0
+    def __call__(self, lines):
+        kept = [l for i, l in enumerate(lines, self.seen) if i % self.n == 0]
+        self.seen += len(lines)
+        return kept
+
+class Tail:
+    def __init__(self, step):
+        self.n = step["n"]
+        self.lines = []
+    def __call__(self, lines):
+        self.lines = (self.lines + lines)[-self.n:] if self.n > 0 else []
+        return []
+    def end(self):
+        return self.lines
+
+class Aggregate:
+    def __init__(self, step):
+        self.pattern = re.compile(step["pattern"].encode())
+        self.interval = step["interval"]
+        self.due = None if self.interval is None else time.monotonic() + self.interval
+        self.count, self.sum, self.min, self.max = 0, 0.0, None, None
+        self.sent = False
+    def __call__(self, lines):
+        for l in lines:
+            m = self.pattern.search(l)
+            if m is None:
+                continue
+            try:
+                v = float(m.group(1) if m.re.groups > 0 else m.group(0))
+            except ValueError:
+                continue
+            self.count += 1
+            self.sum += v
+            self.min = v if self.min is None or v < self.min else self.min
+            self.max = v if self.max is None or v > self.max else self.max
+        return []
+    def summary(self):
+        mean = self.sum / self.count if self.count > 0 else 0.0
+        line = b"jumbonet-aggregate count=%d sum=%r min=%r max=%r mean=%r" % \
+               (self.count, self.sum, self.min or 0.0, self.max or 0.0, mean)
+        self.count, self.sum, self.min, self.max = 0, 0.0, None, None
+        self.sent = True
+        return [line]
+    def tick(self, now):
+        if self.due is None or now < self.due:
+            return []
+        self.due = now + self.interval
+        return self.summary()
+    def end(self):
+        return self.summary() if self.count > 0 or not self.sent else []
+
+KINDS = {"grep": Grep, "every": Every, "tail": Tail, "aggregate": Aggregate}
+chain = [KINDS[step["op"]](step) for step in steps]
+out = sys.stdout.buffer
+
+def run(lines, start = 0):
+    for step in chain[start:]:
+        lines = step(lines)
+    return lines
+
+def emit(lines):
+    if lines:
+        out.write(b"".join(l + b"\n" for l in lines))
+        out.flush()
+
+partial = b""
+try:
+    while True:
+        timeout = None
+        dues = [s.due for s in chain if getattr(s, "due", None) is not None]
+        if dues:
+            timeout = max(0, min(dues) - time.monotonic())
+        ready, _, _ = select.select([src], [], [], timeout)
+        if ready:
+            try:
+                data = os.read(src, 65536)
+            except OSError:
+                data = b""
+            if not data:
+                break
+            lines = (partial + data).split(b"\n")
+            partial = lines.pop()
+            if tty:
+                lines = [l.rstrip(b"\r") for l in lines]
+            emit(run(lines))
+        now = time.monotonic()
+        for i, s in enumerate(chain):
+            if hasattr(s, "tick"):
+                emit(run(s.tick(now), i + 1))
+
+    if partial:
+        emit(run([partial]))
+    for i, s in enumerate(chain):
+        if hasattr(s, "end"):
+            emit(run(s.end(), i + 1))
+except OSError:
+    # the controller is gone
+    forward(signal.SIGHUP, None)
+except Exception:
+    # a broken step must not hide the exitcode, the command cannot go on without its output being read
+    import traceback
+    traceback.print_exc()
+    forward(signal.SIGHUP, None)
+
+code = child.wait()
+sys.exit(code if code >= 0 else 128 - code)
+'''
@@ -1,37 +1,284 @@
 import logging
 from multiprocessing.pool import ThreadPool
+import selectors
+import socket
 import time
 import sys
 import traceback
 from . import remote
+from . import deploy as deploymod
+from . import metrics
 
 log = logging.getLogger(__name__)
 
+# upper bound for how long the mainloop sleeps without any channel becoming readable
+IDLE_TIMEOUT = 1.0
+# poll interval for processes whose output is drained but whose exit status is still in flight
+# it doubles on every poll up to EXIT_BACKOFF, e.g. for a command that closed its stdout long before it exits
+EXIT_TIMEOUT = 0.001
+EXIT_BACKOFF = 0.05
+
+
+class ConnectError(Exception):
+    """raised by Master.add_remotes, carries every remote that failed to connect"""
+    def __init__(self, failures, remotes):
+        self.failures = failures # [(name, exception)] in the order of the specs
+        self.remotes = remotes # the remotes that did connect
+        super().__init__("Could not connect to {}".format(", ".join("{} ({})".format(name, e) for name, e in failures)))
+
+
+class Broadcast():
+    """the outcome of Master.broadcast, all times are on the clock of the controller"""
+    def __init__(self):
+        self.processes = {} # remote name -> Process
+        self.rtt = {} # remote name -> round trip time
+        self.offset = {} # remote name -> clock offset (remote - controller)
+        self.start_at = None # the planned start
+        self.started = {} # remote name -> when the command actually started
+        self.skew = None # latest minus earliest start
+        self.uncertainty = None # how far the starts may be off because of the offset estimates
+
+    def __str__(self):
+        return "Broadcast to {} remotes, skew {:.6f}s (+-{:.6f}s)".format(len(self.processes), self.skew, self.uncertainty)
+
 
 class Master():
-    def __init__(self, default_keyfile = None, default_user = None, default_inband_interface = "eth0"):
+    def __init__(self, default_keyfile = None, default_user = None, default_inband_interface = "eth0", dispatcher = None, \
+                 broker = None, recorder = None):
         self.remotes = {}
         self.run = False
+        # a dispatch.Dispatcher to run listener callbacks off the mainloop, None runs them inline
+        self.dispatcher = dispatcher
+        # a record.Recorder writing down the output of every process with the time it arrived, closed on shutdown
+        self.recorder = recorder
+        # the socket of a jumbonet.broker (True for the default one) remotes connect through unless add_remote says otherwise
+        self.broker = broker
+        # the arguments of start_sampling while remotes added later should be sampled as well
+        self.sampling = None
 
         #used for convenience in mininet-like function addHost
         self.default_keyfile = default_keyfile
         self.default_user = default_user
         self.default_inband_interface = default_inband_interface
+
+        # the mainloop waits on the channels of all running processes instead of polling them
+        self.selector = selectors.DefaultSelector()
+        self.watched = {} # process -> (remote, fd)
+        self.exit_polls = {} # process at eof -> (when to check it next, poll interval after that)
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+        self.looping = False # whether the mainloop thread owns the selector and closes it when it ends
+
+        metrics.REGISTRY.gauge("jumbonet_running_processes", "processes started and not exited yet", ("remote",), \
+                               metrics.bound(self.__running))
+        metrics.REGISTRY.gauge("jumbonet_launch_queue_depth", "processes waiting for a session", ("remote",), \
+                               metrics.bound(self.__queued))
+        metrics.REGISTRY.gauge("jumbonet_dispatch_queued_events", "events waiting for their listeners", ("remote",), \
+                               metrics.bound(self.__dispatch_queued))
+        metrics.REGISTRY.gauge("jumbonet_dispatch_lag_seconds", "age of the oldest event waiting for its listeners", \
+                               ("remote",), metrics.bound(self.__dispatch_lag))
         
     def add_remote(self, name, host, user, remote_password = None, keyfile = None, port = 22,  \
-                   inband_ip = None, inband_mac = None, inband_interface = None):
+                   inband_ip = None, inband_mac = None, inband_interface = None, timeout = None, agent = False, broker = None, \
+                   max_sessions = None):
+
+        r = self.__connect(name, host, user, remote_password = remote_password, keyfile = keyfile, port = port, \
+                           inband_ip = inband_ip, inband_mac = inband_mac, inband_interface = inband_interface, timeout = timeout, \
+                           agent = agent, broker = broker, max_sessions = max_sessions)
+        return self.__register(r)
 
-        if keyfile is None and remote is None:
-            raise Exception("Either provide remote_password in plaintext (not recommended) or keyfile=path/to/ssh/private/key")
+    def add_remotes(self, specs, max_workers = 16, timeout = 10):
+        """
+        connect many remotes concurrently
+        :param specs a list of dicts holding the keyword arguments of add_remote for each remote
+        :param max_workers the number of handshakes in flight at once
+        :param timeout the connect timeout per remote in seconds, unless a spec sets its own
+        returns the remotes in the order of specs, raises a ConnectError listing all remotes that failed
+        """
+        if len(specs) == 0:
+            return []
 
+        pool = ThreadPool(processes = min(max_workers, len(specs)))
         try:
-            r = remote.Remote(name, host, user, keyfile = keyfile, remote_password=remote_password, port = port, \
-                              inband_ip = inband_ip, inband_mac = inband_mac, inband_interface=inband_interface)
-        except:
-            raise
-        
-        self.remotes[name] = r
+            pending = []
+            for spec in specs:
+                kwargs = dict(spec)
+                kwargs.setdefault("timeout", timeout)
+                pending.append((spec.get("name"), pool.apply_async(self.__connect_sampled, (self.sampling,), kwargs)))
+
+            remotes = []
+            failures = []
+            for name, result in pending:
+                try:
+                    remotes.append(self.__register(result.get(), sample = False))
+                except Exception as e:
+                    log.error("Could not connect to Remote: {} ({})".format(name, e))
+                    failures.append((name, e))
+        finally:
+            pool.close()
+            pool.join()
+
+        if len(failures) > 0:
+            raise ConnectError(failures, remotes)
+
+        return remotes
+
+    def broadcast(self, cmd_or_map, listener, start_at = None, remotes = None, samples = 5, guard = 0.05, **kwargs):
+        """
+        start commands on many remotes at the same time
+        all channels are opened and the clocks of the remotes are probed beforehand, then every remote
+        is told to start at the same instant on its own clock, which removes channel setup and round trip
+        time from the start skew
+        :param cmd_or_map the args for every remote or a dict remote name -> args
+        :param start_at when to start (time.time() of the controller), by default as soon as all remotes are ready
+        :param remotes the names of the remotes to use if cmd_or_map is a list, default all
+        :param samples the number of clock probes per remote
+        :param guard seconds added to the slowest round trip when start_at is not given
+        any other keyword arguments are passed to Remote.arm
+        returns a Broadcast, requires a python3 interpreter on the remotes
+        """
+        if isinstance(cmd_or_map, dict):
+            commands = cmd_or_map
+        else:
+            names = remotes if remotes is not None else list(self.remotes.keys())
+            commands = dict((name, cmd_or_map) for name in names)
+
+        names = list(commands.keys())
+        if len(names) == 0:
+            raise Exception("Nothing to broadcast to")
+
+        b = Broadcast()
+
+        def prepare(name):
+            r = self.remotes[name]
+            p = r.arm(commands[name], listener, **kwargs)
+            try:
+                return p, r.probe_clock(p, samples)
+            except Exception:
+                r.disarm(p)
+                raise
+
+        pool = ThreadPool(processes = len(names))
+        try:
+            pending = [(name, pool.apply_async(prepare, (name,))) for name in names]
+            failures = []
+            for name, result in pending:
+                try:
+                    p, (rtt, offset) = result.get()
+                    b.processes[name] = p
+                    b.rtt[name] = rtt
+                    b.offset[name] = offset
+                except Exception as e:
+                    failures.append((name, e))
+
+            if len(failures) > 0:
+                self.__disarm(b.processes)
+                raise Exception("Could not prepare broadcast on {}".format( \
+                    ", ".join("{} ({})".format(name, e) for name, e in failures)))
+
+            if start_at is None:
+                start_at = time.time() + max(b.rtt.values()) + guard
+            b.start_at = start_at
+
+            released = []
+            for name in names:
+                try:
+                    self.remotes[name].release(b.processes[name], start_at + b.offset[name])
+                    released.append(name)
+                except Exception as e:
+                    failures.append((name, e))
+
+            results = [(name, pool.apply_async(self.remotes[name].await_start, (b.processes[name],))) for name in released]
+            for name, result in results:
+                try:
+                    b.started[name] = result.get() - b.offset[name]
+                except Exception as e:
+                    failures.append((name, e))
+
+            # a broadcast that does not start everywhere does not keep running anywhere
+            if len(failures) > 0:
+                self.__disarm(b.processes)
+                raise Exception("Could not start broadcast on {}".format( \
+                    ", ".join("{} ({})".format(name, e) for name, e in failures)))
+        finally:
+            pool.close()
+            pool.join()
+
+        b.skew = max(b.started.values()) - min(b.started.values())
+        b.uncertainty = max(b.rtt.values()) / 2
+        log.info("Broadcast {} to {} remotes, skew {:.6f}s".format(cmd_or_map if not isinstance(cmd_or_map, dict) else "", \
+                                                                  len(names), b.skew))
+        return b
+
+    def __disarm(self, processes):
+        for name, p in processes.items():
+            try:
+                self.remotes[name].disarm(p)
+            except Exception as e:
+                log.error("Could not kill {} @ {} ({})".format(p.command, name, e))
+
+    def deploy(self, local_paths, remote_dir, remotes = None, max_workers = 16):
+        """
+        make sure remote_dir on the remotes holds the given files and directories
+        only files whose sha256 differs from the copy on the remote are uploaded, so repeating a deployment
+        with an unchanged toolset costs a single round trip per remote
+        :param local_paths files and directories to deploy, directories keep their name
+        :param remotes the names of the remotes to deploy to, default all
+        returns remote name -> dict with the uploaded files, the number of unchanged ones, bytes and seconds
+        """
+        names = remotes if remotes is not None else list(self.remotes.keys())
+        files = [(path, name, deploymod.sha256(path)) for path, name in deploymod.local_files(local_paths)]
+        if len(names) == 0 or len(files) == 0:
+            return {}
+
+        pool = ThreadPool(processes = min(max_workers, len(names)))
+        try:
+            pending = [(name, pool.apply_async(deploymod.deploy_remote, (self.remotes[name], files, remote_dir))) for name in names]
+            results = {}
+            failures = []
+            for name, result in pending:
+                try:
+                    results[name] = result.get()
+                except Exception as e:
+                    log.error("Could not deploy to {} ({})".format(name, e))
+                    failures.append((name, e))
+        finally:
+            pool.close()
+            pool.join()
+
+        if len(failures) > 0:
+            raise Exception("Could not deploy to {}".format(", ".join("{} ({})".format(name, e) for name, e in failures)))
+
+        return results
+
+    def __connect(self, name, host, user, remote_password = None, keyfile = None, port = 22,  \
+                  inband_ip = None, inband_mac = None, inband_interface = None, timeout = None, agent = False, broker = None, \
+                  max_sessions = None):
+
+        if keyfile is None and remote_password is None:
+            log.debug("Neither remote_password nor keyfile given for {}, trying the ssh agent and default keys".format(name))
+
+        return remote.Remote(name, host, user, keyfile = keyfile, remote_password=remote_password, port = port, \
+                             inband_ip = inband_ip, inband_mac = inband_mac, inband_interface=inband_interface, timeout = timeout, \
+                             agent = agent, max_sessions = max_sessions, broker = self.broker if broker is None else broker)
+
+    def __connect_sampled(self, sampling, **kwargs):
+        """connect and start sampling in the same worker, so neither adds up over the remotes of add_remotes"""
+        r = self.__connect(**kwargs)
+        if sampling is not None:
+            self.__sample(r, sampling)
+        return r
+
+    def __register(self, r, sample = True):
+        r.wakeup = self.wakeup
+        r.dispatcher = self.dispatcher
+        r.recorder = self.recorder
+        self.remotes[r.name] = r
         log.info("Connected to Remote: %s at %s:%s" %(r.name, r.host, r.port))
+        if sample and self.sampling is not None:
+            self.__sample(r, self.sampling)
         return r
 
     def addHost(self, name, ip, mac, **kwargs):
@@ -49,22 +296,74 @@ class Master():
                                inband_ip=ip, inband_mac=mac, inband_iface=inband_iface)
 
         
+    def run_batch(self, cmd_or_map, remotes = None, max_workers = 16, **kwargs):
+        """
+        run a batch of commands on many remotes in parallel, see Remote.run_batch
+        :param cmd_or_map the commands for every remote or a dict remote name -> commands
+        :param remotes the names of the remotes to use if cmd_or_map is a list, default all
+        any other keyword arguments are passed to Remote.run_batch
+        returns remote name -> [CommandResult]
+        """
+        if isinstance(cmd_or_map, dict):
+            batches = cmd_or_map
+        else:
+            names = remotes if remotes is not None else list(self.remotes.keys())
+            batches = {name: cmd_or_map for name in names}
+        if len(batches) == 0:
+            return {}
+
+        pool = ThreadPool(processes = min(max_workers, len(batches)))
+        try:
+            pending = [(name, pool.apply_async(self.remotes[name].run_batch, (commands,), kwargs)) \
+                       for name, commands in batches.items()]
+            results = {}
+            failures = []
+            for name, result in pending:
+                try:
+                    results[name] = result.get()
+                except Exception as e:
+                    log.error("Could not run the batch on {} ({})".format(name, e))
+                    failures.append((name, e))
+        finally:
+            pool.close()
+            pool.join()
+
+        if len(failures) > 0:
+            raise Exception("Could not run the batch on {}".format(", ".join("{} ({})".format(name, e) for name, e in failures)))
+
+        return results
+
     def mainloop(self):        
         log.debug("Forking mainloop")
         self.run = True
+        self.looping = True
         
         pool = ThreadPool(processes = 1)
         pool.apply_async(self.__mainloop)
+        pool.close()
     
     def __mainloop(self):
         log.debug("Mainloop started")
         while self.run:
             try:
-                time.sleep(0.5)
                 self.__watch_remotes()
         
             except:
                 traceback.print_exc()
+        self.__close_selector()
+
+    def __close_selector(self):
+        self.selector.close()
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+
+    def wakeup(self):
+        """interrupt the mainloop so it picks up new, killed or finished processes"""
+        try:
+            self.wakeup_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            # a wakeup is already pending or we are shutting down
+            pass
 
         
     def stop(self):
@@ -73,23 +372,185 @@ class Master():
 
     def shutdown(self):
         self.run = False
+        self.wakeup()
         
         log.info("Disconnecting remotes")
         for remote in self.remotes.values():
             remote.shutdown()
             log.info("-- Disconnected {} ({}:{})".format(remote.name, remote.host, remote.port))
+
+        if self.dispatcher is not None:
+            # lets the workers deliver what is still queued
+            self.dispatcher.close()
+
+        if self.recorder is not None:
+            self.recorder.close()
+
+        if not self.looping:
+            # no mainloop thread to do it, e.g. under AsyncMaster
+            self.__close_selector()
         
   
+    def start_sampling(self, rate = 20, **kwargs):
+        """
+        sample the load of every remote, including those added later, from /proc, see Remote.start_sampler
+        a remote the sampler cannot be started on is logged and left out
+        returns remote name -> Sampler
+        """
+        self.sampling = dict(kwargs, rate = rate)
+        remotes = list(self.remotes.values())
+        if len(remotes) == 0:
+            return {}
+
+        pool = ThreadPool(processes = min(16, len(remotes)))
+        try:
+            started = pool.map(lambda r: self.__sample(r, self.sampling), remotes)
+        finally:
+            pool.close()
+            pool.join()
+        return {r.name: sampler for r, sampler in zip(remotes, started) if sampler is not None}
+
+    def __sample(self, r, kwargs):
+        try:
+            return r.start_sampler(**kwargs)
+        except Exception as e:
+            log.warning("Not sampling {} ({})".format(r.name, e))
+            return None
+
+    def stop_sampling(self):
+        """stop sampling on all remotes, returns remote name -> Sampler holding the samples"""
+        self.sampling = None
+        samplers = {}
+        for r in list(self.remotes.values()):
+            sampler = r.stop_sampler()
+            if sampler is not None:
+                samplers[r.name] = sampler
+        return samplers
+
+    def metrics(self):
+        """a snapshot of the jumbonet metrics, see jumbonet.metrics"""
+        return metrics.REGISTRY.snapshot()
+
+    def serve_metrics(self, port, host = "127.0.0.1"):
+        """serve the metrics in prometheus text format on http://host:port/metrics"""
+        return metrics.REGISTRY.serve(port, host = host)
+
+    def __running(self):
+        return {(r.name,): sum(1 for p in list(r.live) if p.exitcode is None) for r in list(self.remotes.values())}
+
+    def __queued(self):
+        return {(r.name,): r.queue_depth() for r in list(self.remotes.values())}
+
+    def __dispatch_queued(self):
+        queued = {(r.name,): 0 for r in list(self.remotes.values())}
+        if self.dispatcher is not None:
+            with self.dispatcher.lock:
+                queues = list(self.dispatcher.queues.values())
+            for q in queues:
+                queued[(q.remotename,)] = queued.get((q.remotename,), 0) + len(q.events)
+        return queued
+
+    def __dispatch_lag(self):
+        lag = {(r.name,): 0.0 for r in list(self.remotes.values())}
+        if self.dispatcher is not None:
+            now = time.monotonic()
+            with self.dispatcher.lock:
+                queues = list(self.dispatcher.queues.values())
+            for q in queues:
+                with q.cond:
+                    oldest = now - q.events[0][0] if len(q.events) > 0 else 0.0
+                lag[(q.remotename,)] = max(lag.get((q.remotename,), 0.0), oldest)
+        return lag
+
+    def __sync_watched(self):
+        """
+        (un)register the channels of all running processes with the selector
+        returns the processes that need to be checked without waiting for their channel
+        """
+        pending = []
+        now = time.monotonic()
+
+        for p in list(self.exit_polls):
+            if p.exitcode is not None:
+                del self.exit_polls[p]
+
+        for p, (r, fd) in list(self.watched.items()):
+            if p.exitcode is None and not p.chan.closed and not p.chan.eof_received:
+                continue
+            # the pipe of a closed channel is gone, the one of a channel at eof stays readable forever
+            try:
+                self.selector.unregister(fd)
+            except (KeyError, ValueError, OSError):
+                pass
+            del self.watched[p]
+
+        for r in list(self.remotes.values()):
+            for p in list(r.live):
+                if p.exitcode is not None or p in self.watched:
+                    continue
+
+                if p.chan is None:
+                    # still waiting for a session
+                    if p.cancelled:
+                        pending.append((r, p))
+                    continue
+
+                if p.chan.closed or p.chan.eof_received:
+                    if self.__exit_due(p, now):
+                        pending.append((r, p))
+                    continue
+
+                fd = p.chan.fileno()
+                self.selector.register(fd, selectors.EVENT_READ, (r, p))
+                self.watched[p] = (r, fd)
+                # data may have arrived before we registered
+                pending.append((r, p))
+
+        return pending
+
+    def __exit_due(self, p, now):
+        """whether to check p for its exit status now, backs off while it has none"""
+        due, interval = self.exit_polls.get(p, (now, EXIT_TIMEOUT))
+        if now < due:
+            return False
+        self.exit_polls[p] = (now + interval, min(interval * 2, EXIT_BACKOFF))
+        return True
+
     def __watch_remotes(self):
-        log.debug("Watching remotes")
-        for r in self.remotes.values():
-            r.check_processes()
+        start = time.perf_counter()
+        pending = self.__sync_watched()
+        busy = time.perf_counter() - start
+
+        timeout = IDLE_TIMEOUT
+        if len(pending) > 0:
+            timeout = 0
+        elif len(self.exit_polls) > 0:
+            timeout = min(timeout, max(0, min(due for due, _ in self.exit_polls.values()) - time.monotonic()))
+
+        events = self.selector.select(timeout)
+        start = time.perf_counter()
+        for key, _ in events:
+            if key.fileobj is self.wakeup_r:
+                try:
+                    while self.wakeup_r.recv(4096):
+                        pass
+                except (BlockingIOError, OSError):
+                    pass
+                continue
+
+            pending.append(key.data)
+
+        metrics.READY.inc(len(pending))
+        for r, p in pending:
+            r.check_process(p)
+        metrics.TICK.observe(busy + time.perf_counter() - start)
 
     def kill_process(self, uuid, remotename = None):
         p = self.get_process(uuid, remotename)
 
         if p is not None:
             p.kill()
+            self.wakeup()
         else:
             log.error("Could not find {}@{}".format(uuid, remotename))
 
@@ -98,6 +559,7 @@ class Master():
         for uuid, r in self.remotes.items():
             r.killall()
             r.check_processes()
+        self.wakeup()
 
     def get_process(self, uuid, remotename = None):
         p = None
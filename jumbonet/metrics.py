@@ -0,0 +1,267 @@
+import bisect
+import http.server
+import logging
+import threading
+import time
+import weakref
+
+log = logging.getLogger(__name__)
+
+# numbers about jumbonet itself: channel opens, bytes read, mainloop ticks, listener callbacks, queued events
+# Master, Remote and Process feed the module wide REGISTRY, read it with
+#   net.metrics()                      # a snapshot dict
+#   metrics.REGISTRY.prometheus()      # prometheus text exposition format
+#   net.serve_metrics(9100)            # http://127.0.0.1:9100/metrics
+
+# seconds, from 50us to 10s
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, \
+                   2.5, 5.0, 10.0)
+
+
+class Counter():
+    def __init__(self, name, help, labels = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {} # label values -> count
+        self.lock = threading.Lock()
+
+    def inc(self, amount = 1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return list(self.values.items())
+
+    def snapshot(self):
+        return {_key(labels): value for labels, value in self.samples()}
+
+    def prometheus(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} counter".format(self.name)]
+        for labels, value in sorted(self.samples()):
+            lines.append("{}{} {}".format(self.name, _labels(self.labels, labels), value))
+        return lines
+
+
+class Histogram():
+    """counts observations into fixed buckets, cumulative only when exported"""
+    def __init__(self, name, help, labels = (), buckets = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.values = {} # label values -> [bucket counts + overflow, sum, max]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            v = self.values.get(labels)
+            if v is None:
+                v = [[0] * (len(self.buckets) + 1), 0.0, 0.0]
+                self.values[labels] = v
+            v[0][i] += 1
+            v[1] += value
+            if value > v[2]:
+                v[2] = value
+
+    def time(self, *labels):
+        """observe how long a with block takes"""
+        return Timer(self, labels)
+
+    def samples(self):
+        with self.lock:
+            return [(labels, (list(counts), total, top)) for labels, (counts, total, top) in self.values.items()]
+
+    def snapshot(self):
+        snapshot = {}
+        for labels, (counts, total, top) in self.samples():
+            n = sum(counts)
+            snapshot[_key(labels)] = {"count": n, "sum": total, "mean": total / n if n > 0 else 0.0, "max": top, \
+                                      "p50": self._quantile(counts, 0.5), "p99": self._quantile(counts, 0.99)}
+        return snapshot
+
+    def _quantile(self, counts, q):
+        """the upper bound of the bucket holding the q quantile"""
+        n = sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            seen += count
+            if seen >= q * n and n > 0:
+                return bound
+        return 0.0
+
+    def prometheus(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} histogram".format(self.name)]
+        for labels, (counts, total, top) in sorted(self.samples()):
+            seen = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                seen += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append("{}_bucket{} {}".format(self.name, _labels(self.labels + ("le",), labels + (le,)), seen))
+            lines.append("{}_sum{} {}".format(self.name, _labels(self.labels, labels), total))
+            lines.append("{}_count{} {}".format(self.name, _labels(self.labels, labels), seen))
+        return lines
+
+
+class Gauge():
+    """read when exported, fn returns {label values: value}"""
+    def __init__(self, name, help, labels = (), fn = None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.fn = fn
+
+    def samples(self):
+        if self.fn is None:
+            return []
+        try:
+            return list(self.fn().items())
+        except:
+            log.exception("Could not read {}".format(self.name))
+            return []
+
+    def snapshot(self):
+        return {_key(labels): value for labels, value in self.samples()}
+
+    def prometheus(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} gauge".format(self.name)]
+        for labels, value in sorted(self.samples()):
+            lines.append("{}{} {}".format(self.name, _labels(self.labels, labels), value))
+        return lines
+
+
+class Timer():
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class Registry():
+    def __init__(self):
+        self.metrics = {} # name -> Counter/Histogram/Gauge
+        self.lock = threading.Lock()
+        self.server = None
+
+    def _add(self, metric):
+        with self.lock:
+            known = self.metrics.get(metric.name)
+            if known is not None and type(known) is type(metric) and not isinstance(metric, Gauge):
+                return known
+            # gauges are rebound to whoever registers them last, e.g. a new Master
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help, labels = ()):
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels = (), buckets = LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, labels = (), fn = None):
+        return self._add(Gauge(name, help, labels, fn))
+
+    def reset(self):
+        """forget all counted values, e.g. between testcases"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            if not isinstance(metric, Gauge):
+                with metric.lock:
+                    metric.values.clear()
+
+    def snapshot(self):
+        """name -> {"label=value,...": value}, histograms as count, sum, mean, max and bucketed p50/p99"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def prometheus(self):
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key = lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.prometheus())
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host = "127.0.0.1"):
+        """serve the prometheus text on http://host:port/metrics from a background thread, returns the server"""
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug(format % args)
+
+        self.close()
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target = self.server.serve_forever, name = "jumbonet-metrics", daemon = True).start()
+        log.info("Serving metrics on http://{}:{}/metrics".format(host, self.server.server_address[1]))
+        return self.server
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def bound(method):
+    """a gauge function calling method on an object without keeping the object alive"""
+    ref = weakref.WeakMethod(method)
+
+    def fn():
+        m = ref()
+        return {} if m is None else m()
+    return fn
+
+
+def _key(labels):
+    return ",".join(str(l) for l in labels)
+
+
+def _labels(names, values):
+    if len(names) == 0:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append("{}=\"{}\"".format(name, value))
+    return "{" + ",".join(pairs) + "}"
+
+
+REGISTRY = Registry()
+
+CHANNEL_OPEN = REGISTRY.histogram("jumbonet_channel_open_seconds", "time to open a session and start a command on it", \
+                                  ("remote",))
+PROCESSES_STARTED = REGISTRY.counter("jumbonet_processes_started_total", "processes started", ("remote",))
+# per remote only, a label per process would grow the registry with every process ever started,
+# the counts of a single process are kept on it, see Process.bytes_received and Process.stdin_stats
+PROCESS_BYTES = REGISTRY.counter("jumbonet_process_bytes_received_total", "bytes read from the streams of processes", \
+                                 ("remote", "stream"))
+PROCESS_BYTES_SENT = REGISTRY.counter("jumbonet_process_bytes_sent_total", "bytes written to the stdin of processes", \
+                                      ("remote",))
+READS = REGISTRY.counter("jumbonet_reads_total", "reads of process channels", ("remote",))
+CHECK = REGISTRY.histogram("jumbonet_check_seconds", "time to read a process and hand its output on", ("remote",))
+LISTENER = REGISTRY.histogram("jumbonet_listener_seconds", "time spent in listener callbacks", ("remote",))
+TICK = REGISTRY.histogram("jumbonet_mainloop_tick_seconds", "time the mainloop spends per wakeup, without waiting")
+READY = REGISTRY.counter("jumbonet_mainloop_ready_total", "processes the mainloop found ready to be read")
@@ -0,0 +1,231 @@
+import array
+import collections
+import collections.abc
+import logging
+import os
+import tempfile
+import threading
+import weakref
+
+log = logging.getLogger(__name__)
+
+# retention policies for the stdout/stderr lines a Process keeps around
+# popen takes a factory which is called once per stream, e.g.
+#   remote.popen(["ping", "10.0.0.2"], self, retention = output.keep_last(lines = 1000))
+
+
+def keep_all():
+    """keep every line in memory (the default)"""
+    return list
+
+
+def keep_last(lines = None, max_bytes = None):
+    """keep only the most recent lines, bounded by their number and/or their size in bytes"""
+    return lambda: RingBuffer(lines = lines, max_bytes = max_bytes)
+
+
+def spill(directory = None):
+    """write every line to a segment file on disk, only the offset index stays in memory"""
+    return lambda: SpillFile(directory = directory)
+
+
+# destinations for the raw bytes of a stream, see the stdout_to and stderr_to arguments of popen
+
+
+def sink(target):
+    """
+    wrap where the bytes of a stream should go
+    :param target a path, a file-like object with write (left open) or a writable buffer such as a bytearray
+    """
+    if isinstance(target, (FileSink, BufferSink, WriterSink)):
+        return target
+    if isinstance(target, (str, bytes, os.PathLike)):
+        return FileSink(target)
+    if hasattr(target, "write"):
+        return WriterSink(target)
+    return BufferSink(target)
+
+
+class FileSink():
+    def __init__(self, path, buffering = 1 << 20):
+        self.path = path
+        self.file = open(path, "wb", buffering = buffering)
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def close(self):
+        self.file.close()
+
+    def __repr__(self):
+        return "FileSink({}, {} bytes)".format(self.path, self.size)
+
+
+class WriterSink():
+    """hands the bytes to a file-like object the caller owns and closes"""
+    def __init__(self, writer):
+        self.writer = writer
+        self.size = 0
+
+    def write(self, data):
+        self.writer.write(data)
+        self.size += len(data)
+
+    def close(self):
+        flush = getattr(self.writer, "flush", None)
+        if flush is not None:
+            flush()
+
+
+class BufferSink():
+    """
+    fills a preallocated buffer front to back, bytes that do not fit anymore are counted in dropped
+    view() is a memoryview of what was received
+    """
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer).cast("B")
+        self.size = 0
+        self.dropped = 0
+
+    def write(self, data):
+        n = min(len(data), len(self.buffer) - self.size)
+        if n > 0:
+            self.buffer[self.size:self.size + n] = memoryview(data)[:n] if n < len(data) else data
+            self.size += n
+        self.dropped += len(data) - n
+
+    def view(self):
+        return self.buffer[:self.size]
+
+    def close(self):
+        if self.dropped > 0:
+            log.warning("{} bytes did not fit into the buffer of {} bytes".format(self.dropped, len(self.buffer)))
+
+    def __repr__(self):
+        return "BufferSink({} of {} bytes, {} dropped)".format(self.size, len(self.buffer), self.dropped)
+
+
+class RingBuffer(collections.abc.Sequence):
+    def __init__(self, lines = None, max_bytes = None):
+        self.lines = collections.deque(maxlen = lines)
+        self.sizes = collections.deque(maxlen = lines)
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def extend(self, lines):
+        with self.lock:
+            for line in lines:
+                if len(self.lines) == self.lines.maxlen:
+                    self.size -= self.sizes[0]
+                    self.dropped += 1
+
+                n = len(line.encode("utf-8"))
+                self.lines.append(line)
+                self.sizes.append(n)
+                self.size += n
+
+                while self.max_bytes is not None and self.size > self.max_bytes and len(self.lines) > 0:
+                    self.lines.popleft()
+                    self.size -= self.sizes.popleft()
+                    self.dropped += 1
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, i):
+        with self.lock:
+            if isinstance(i, slice):
+                return list(self.lines)[i]
+            return self.lines[i]
+
+    def __iter__(self):
+        with self.lock:
+            snapshot = list(self.lines)
+        return iter(snapshot)
+
+    def __repr__(self):
+        return "RingBuffer({} lines, {} bytes, {} dropped)".format(len(self.lines), self.size, self.dropped)
+
+
+class SpillFile(collections.abc.Sequence):
+    """
+    lines are appended to a segment file, separated by newlines, and found again through the offset
+    index, lines are only read back from disk when they are accessed
+    """
+    def __init__(self, path = None, directory = None):
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix = "jumbonet-", suffix = ".out", dir = directory)
+            os.close(fd)
+            # a file nobody asked for by name goes away with its buffer
+            weakref.finalize(self, os.unlink, path)
+
+        self.path = path
+        self.file = open(path, "w+b")
+        self.offsets = array.array("Q") # where each line starts
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def extend(self, lines):
+        if len(lines) == 0:
+            return
+
+        with self.lock:
+            chunk = bytearray()
+            for line in lines:
+                self.offsets.append(self.size + len(chunk))
+                chunk += line.encode("utf-8")
+                chunk += b"\n"
+
+            self.file.seek(self.size)
+            self.file.write(chunk)
+            self.size += len(chunk)
+
+    def close(self):
+        """stop writing, the lines remain readable"""
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+    def _read(self, start, end):
+        if self.file.closed:
+            with open(self.path, "rb") as f:
+                f.seek(start)
+                return f.read(end - start)
+
+        self.file.flush()
+        self.file.seek(start)
+        return self.file.read(end - start)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+
+        with self.lock:
+            if i < 0:
+                i += len(self.offsets)
+            if i < 0 or i >= len(self.offsets):
+                raise IndexError("line index out of range")
+
+            end = self.offsets[i + 1] if i + 1 < len(self.offsets) else self.size
+            return self._read(self.offsets[i], end - 1).decode("utf-8")
+
+    def __iter__(self):
+        with self.lock:
+            n = len(self.offsets)
+            if not self.file.closed:
+                self.file.flush()
+
+        # read sequentially instead of seeking for every line
+        with open(self.path, "rb") as f:
+            for i in range(n):
+                yield f.readline()[:-1].decode("utf-8")
+
+    def __repr__(self):
+        return "SpillFile({}, {} lines, {} bytes)".format(self.path, len(self.offsets), self.size)
@@ -0,0 +1,257 @@
+import json
+import logging
+import re
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger(__name__)
+
+# parse the stdout of a process while it arrives, into typed numpy columns instead of keeping the lines around
+# popen takes a Parser, which is fed the lines of every read with the time they were received, e.g.
+#   p = remote.popen(["ping", "-i", "0.01", "10.0.0.2"], self, parser = parsers.Ping(), \
+#                    retention = output.keep_last(lines = 100))
+#   ...
+#   p.parser.result().save("ping.npz")  # columns t, seq, ttl, rtt_ms
+# every result has a column t, the time.time() the line was read on the controller
+# requires the numpy module
+
+
+def _require_numpy():
+    if numpy is None:
+        raise Exception("Parsing into arrays requires the numpy module")
+
+
+class Columns():
+    """
+    typed numpy columns appended to a row at a time
+    they double in size when full, or with fixed = True keep their capacity and count the rows that did not fit
+    """
+    def __init__(self, columns, capacity = 4096, fixed = False):
+        _require_numpy()
+        self.names = [name for name, _ in columns]
+        self.arrays = [numpy.empty(capacity, dtype = dtype) for _, dtype in columns]
+        self.capacity = capacity
+        self.fixed = fixed
+        self.size = 0
+        self.dropped = 0
+
+    def append(self, row):
+        if self.size == self.capacity:
+            if self.fixed:
+                self.dropped += 1
+                return
+            self._grow()
+        i = self.size
+        for array, value in zip(self.arrays, row):
+            array[i] = value
+        self.size += 1
+
+    def _grow(self):
+        self.capacity = max(1, self.capacity * 2)
+        grown = []
+        for array in self.arrays:
+            bigger = numpy.empty(self.capacity, dtype = array.dtype)
+            bigger[:self.size] = array[:self.size]
+            grown.append(bigger)
+        self.arrays = grown
+
+    def result(self):
+        return Series({name: array[:self.size] for name, array in zip(self.names, self.arrays)}, self.dropped)
+
+
+class Series():
+    """the parsed columns, name -> numpy array of equal length"""
+    def __init__(self, columns, dropped = 0):
+        self.columns = columns
+        self.dropped = dropped
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def __repr__(self):
+        return "Series({} rows of {})".format(len(self), ", ".join(self.columns))
+
+    def keys(self):
+        return self.columns.keys()
+
+    def structured(self):
+        """the columns as one numpy structured array"""
+        array = numpy.empty(len(self), dtype = [(name, column.dtype) for name, column in self.columns.items()])
+        for name, column in self.columns.items():
+            array[name] = column
+        return array
+
+    def save(self, path):
+        """write the columns to path, as a structured array if it ends in .npy, else as a .npz of one array each"""
+        path = str(path)
+        if path.endswith(".npy"):
+            numpy.save(path, self.structured())
+        else:
+            numpy.savez(path, **self.columns)
+        log.debug("Saved {} rows to {}".format(len(self), path))
+        return path
+
+
+class Parser():
+    """
+    turns lines into rows of columns, subclasses set columns to (name, dtype) pairs and implement parse
+    :param capacity the rows preallocated
+    :param fixed never grow past capacity, further rows are dropped and counted
+    """
+    columns = ()
+
+    def __init__(self, capacity = 4096, fixed = False):
+        self.data = Columns((("t", "f8"),) + tuple(self.columns), capacity, fixed)
+        self.lines = 0
+
+    def feed(self, lines, t = None):
+        """parse lines received at t, now if None"""
+        t = time.time() if t is None else t
+        self.lines += len(lines)
+        for line in lines:
+            row = self.parse(line)
+            if row is not None:
+                self.data.append((t,) + row)
+
+    def parse(self, line):
+        """the row of line without the time, None to skip it"""
+        raise NotImplementedError()
+
+    def close(self):
+        """the process exited, nothing more will be fed"""
+        pass
+
+    def result(self):
+        return self.data.result()
+
+
+class Regex(Parser):
+    """
+    a row per line the pattern is found in, from its groups
+    :param columns a (name, dtype) per group, by default the named groups of pattern as float64
+    """
+    def __init__(self, pattern, columns = None, capacity = 4096, fixed = False):
+        _require_numpy()
+        self.pattern = re.compile(pattern)
+        if columns is None:
+            names = sorted(self.pattern.groupindex, key = self.pattern.groupindex.get)
+            if len(names) != self.pattern.groups:
+                raise Exception("Name every group of {} or pass columns".format(pattern))
+            columns = [(name, "f8") for name in names]
+        if len(columns) != self.pattern.groups:
+            raise Exception("{} has {} groups but {} columns were given".format(pattern, self.pattern.groups, len(columns)))
+        self.columns = tuple(columns)
+        self.convert = [int if numpy.dtype(dtype).kind in "iub" else float for _, dtype in columns]
+        super().__init__(capacity, fixed)
+
+    def parse(self, line):
+        match = self.pattern.search(line)
+        if match is None:
+            return None
+        try:
+            return tuple(convert(value) for convert, value in zip(self.convert, match.groups()))
+        except (TypeError, ValueError):
+            return None
+
+
+class Ping(Regex):
+    """the replies of ping, columns seq, ttl and rtt_ms"""
+    def __init__(self, capacity = 4096, fixed = False):
+        super().__init__(r"icmp_seq=(\d+) ttl=(\d+) time=([0-9.]+)", (("seq", "i8"), ("ttl", "i4"), ("rtt_ms", "f8")), \
+                         capacity, fixed)
+
+
+# iperf3 counts bytes in powers of 1024 and bits in powers of 1000
+BYTE_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+BIT_UNITS = {"": 1, "K": 1e3, "M": 1e6, "G": 1e9, "T": 1e12}
+
+IPERF3_COLUMNS = (("stream", "i4"), ("start", "f8"), ("end", "f8"), ("bytes", "i8"), ("bits_per_second", "f8"), \
+                  ("retransmits", "i8"))
+
+
+class Iperf3Text(Parser):
+    """
+    the interval lines of iperf3, columns stream (-1 for SUM), start, end, bytes, bits_per_second and
+    retransmits (-1 where iperf3 does not print them)
+    :param summaries also keep the sender/receiver totals printed at the end
+    """
+    columns = IPERF3_COLUMNS
+    LINE = re.compile(r"^\[\s*(\d+|SUM)\]\s+([0-9.]+)-([0-9.]+)\s+sec\s+([0-9.]+) ([KMGT]?)Bytes\s+([0-9.]+) ([KMGT]?)bits/sec(.*)$")
+    RETRANSMITS = re.compile(r"^\s+(\d+)\s+[0-9.]+ [KMGT]?Bytes")
+
+    def __init__(self, summaries = False, capacity = 4096, fixed = False):
+        self.summaries = summaries
+        super().__init__(capacity, fixed)
+
+    def parse(self, line):
+        match = self.LINE.search(line)
+        if match is None:
+            return None
+        stream, start, end, amount, byte_unit, rate, bit_unit, rest = match.groups()
+        if not self.summaries and ("sender" in rest or "receiver" in rest):
+            return None
+        retransmits = self.RETRANSMITS.search(rest)
+        return (-1 if stream == "SUM" else int(stream), float(start), float(end), \
+                int(float(amount) * BYTE_UNITS[byte_unit]), float(rate) * BIT_UNITS[bit_unit], \
+                int(retransmits.group(1)) if retransmits is not None else -1)
+
+
+class Iperf3Json(Parser):
+    """
+    the intervals of iperf3 -J or --json-stream, columns like Iperf3Text, a row per stream and one for their sum
+    --json-stream hands every interval over as it happens, -J prints one document once iperf3 is done,
+    so its intervals all carry the time it arrived
+    """
+    columns = IPERF3_COLUMNS
+
+    def __init__(self, capacity = 4096, fixed = False):
+        self.document = [] # the lines of a -J document
+        super().__init__(capacity, fixed)
+
+    def feed(self, lines, t = None):
+        t = time.time() if t is None else t
+        self.lines += len(lines)
+        for line in lines:
+            if len(self.document) == 0 and line.startswith("{") and line.rstrip().endswith("}"):
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    event = None
+                if isinstance(event, dict) and "event" in event:
+                    if event["event"] == "interval":
+                        self._interval(t, event["data"])
+                    elif event["event"] == "error":
+                        log.warning("iperf3: {}".format(event["data"]))
+                    continue
+            self.document.append(line)
+        self.t = t
+
+    def close(self):
+        if len(self.document) == 0:
+            return
+        try:
+            document = json.loads("\n".join(self.document))
+        except ValueError:
+            log.warning("Could not parse the iperf3 output as json")
+            return
+        finally:
+            self.document = []
+        if "error" in document:
+            log.warning("iperf3: {}".format(document["error"]))
+        for interval in document.get("intervals", []):
+            self._interval(self.t, interval)
+
+    def _interval(self, t, interval):
+        rows = [(stream.get("socket", 0), stream) for stream in interval.get("streams", [])]
+        if "sum" in interval:
+            rows.append((-1, interval["sum"]))
+        for stream, values in rows:
+            self.data.append((t, stream, values["start"], values["end"], values["bytes"], values["bits_per_second"], \
+                              values.get("retransmits", -1)))
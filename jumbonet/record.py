@@ -0,0 +1,266 @@
+import json
+import logging
+import mmap
+import struct
+import threading
+import time
+from . import remote as remotemod
+
+log = logging.getLogger(__name__)
+
+# records every chunk read from the processes with the time it arrived, to look at or replay later
+#   net = master.Master(recorder = record.Recorder("run.jnrec"))
+#   ...
+#   net.shutdown()  # closes the recorder
+#   rec = record.Recording("run.jnrec")
+#   for t, remote, uuid, stream, line in rec.lines(start = 1.0, end = 2.5): ...
+#   rec.replay(subscriber)
+#
+# run.jnrec holds the chunks, appended as they are read, each preceded by a CHUNK header
+# run.jnrec.idx holds an INDEX entry per chunk, so chunks can be found by time or process without reading them
+# times are time.monotonic_ns() when the chunk was read, the file header keeps the wall clock time at the start
+
+MAGIC = b"JNREC\x00\x01\x00"
+FILE_HEADER = struct.Struct("<8sqd") # magic, monotonic ns at the start, time.time() at the start
+CHUNK = struct.Struct("<qIBxxxI") # monotonic ns, process number, stream, length
+INDEX = struct.Struct("<qQIBxxx") # monotonic ns, offset of the chunk header, process number, stream
+
+STDOUT = 0
+STDERR = 1
+EXIT = 2 # the payload is the exitcode
+PROCESS = 3 # the payload is json {"remote", "uuid", "args"}, precedes any chunk of the process
+
+EXITCODE = struct.Struct("<i")
+
+
+class Recorder():
+    """
+    the writing end, hand it to a Master (or set remote.recorder) and every process started afterwards is recorded
+    a chunk costs a header and two buffered writes, decoding and line splitting are left to the reader
+    """
+    def __init__(self, path, buffering = 1 << 20):
+        self.path = path
+        self.log = open(path, "wb", buffering = buffering)
+        self.index = open(path + ".idx", "wb", buffering = buffering)
+        self.origin = time.monotonic_ns()
+        header = FILE_HEADER.pack(MAGIC, self.origin, time.time())
+        self.log.write(header)
+        self.index.write(header)
+        self.log.flush()
+        self.index.flush()
+        self.offset = len(header)
+        self.processes = 0
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def attach(self, process):
+        """record the output and exit status of process"""
+        info = json.dumps({"remote": process.remotename, "uuid": process.uuid, \
+                           "args": [str(a) for a in process.args]}).encode("utf-8")
+        # numbers are handed out in the order the PROCESS entries are written, Recording relies on it
+        with self.lock:
+            number = self.processes
+            self.processes += 1
+            self._write(number, PROCESS, info)
+
+        process.recorder = self
+        process.recorded = number
+        process.stdout_reader.sink = lambda data: self._append(number, STDOUT, data)
+        process.stderr_reader.sink = lambda data: self._append(number, STDERR, data)
+
+    def exit(self, process, exitcode):
+        self._append(process.recorded, EXIT, EXITCODE.pack(-1 if exitcode is None else exitcode))
+
+    def _append(self, number, stream, data):
+        with self.lock:
+            self._write(number, stream, data)
+
+    def _write(self, number, stream, data):
+        # the lock is held
+        if self.closed:
+            return
+        now = time.monotonic_ns()
+        self.index.write(INDEX.pack(now, self.offset, number, stream))
+        self.log.write(CHUNK.pack(now, number, stream, len(data)))
+        self.log.write(data)
+        self.offset += CHUNK.size + len(data)
+
+    def flush(self):
+        """make everything recorded so far visible to a Recording"""
+        with self.lock:
+            if not self.closed:
+                self.log.flush()
+                self.index.flush()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.log.close()
+            self.index.close()
+        log.info("Recorded {} processes, {} bytes to {}".format(self.processes, self.offset, self.path))
+
+
+class Recording():
+    """
+    the reading end, maps a recording into memory, also works on one that is still being written
+    times handed out are seconds since the recording started
+    """
+    def __init__(self, path):
+        self.path = path
+        self.log_file = open(path, "rb")
+        self.index_file = open(path + ".idx", "rb")
+        self.log = mmap.mmap(self.log_file.fileno(), 0, access = mmap.ACCESS_READ)
+        self.index = mmap.mmap(self.index_file.fileno(), 0, access = mmap.ACCESS_READ)
+
+        magic, self.origin, self.wallclock = FILE_HEADER.unpack_from(self.log, 0)
+        if magic != MAGIC:
+            raise Exception("{} is not a jumbonet recording".format(path))
+        # a recording still being written or cut short by a crash may end in a partial entry or chunk
+        self.entries = (len(self.index) - FILE_HEADER.size) // INDEX.size
+        while self.entries > 0:
+            offset = self._entry(self.entries - 1)[1]
+            if offset + CHUNK.size <= len(self.log) and \
+               offset + CHUNK.size + CHUNK.unpack_from(self.log, offset)[3] <= len(self.log):
+                break
+            self.entries -= 1
+
+        self.processes = [] # process number -> {"remote", "uuid", "args"}
+        self.numbers = {} # uuid -> process number
+        self.exitcodes = {} # uuid -> exitcode
+        for i in range(self.entries):
+            t, offset, number, stream = self._entry(i)
+            if stream == PROCESS:
+                info = json.loads(bytes(self._payload(offset)).decode("utf-8"))
+                self.processes.append(info)
+                self.numbers[info["uuid"]] = number
+            elif stream == EXIT:
+                self.exitcodes[self.processes[number]["uuid"]] = EXITCODE.unpack(self._payload(offset))[0]
+
+    def close(self):
+        self.log.close()
+        self.index.close()
+        self.log_file.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.entries
+
+    def _entry(self, i):
+        return INDEX.unpack_from(self.index, FILE_HEADER.size + i * INDEX.size)
+
+    def _payload(self, offset):
+        t, number, stream, length = CHUNK.unpack_from(self.log, offset)
+        start = offset + CHUNK.size
+        return memoryview(self.log)[start:start + length]
+
+    def _find(self, t):
+        """the first entry at or after t seconds"""
+        ns = self.origin + int(t * 1e9)
+        lo, hi = 0, self.entries
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid)[0] < ns:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def wallclock_of(self, t):
+        """the time.time() of t seconds into the recording"""
+        return self.wallclock + t
+
+    def chunks(self, uuid = None, start = None, end = None, streams = (STDOUT, STDERR, EXIT)):
+        """
+        (seconds, remote, uuid, stream, payload) for every chunk in order, payload is a memoryview into the recording
+        :param uuid only the chunks of this process, or of these processes if a collection
+        :param start, end only chunks read in this range of seconds since the start of the recording
+        """
+        wanted = None
+        if uuid is not None:
+            uuids = [uuid] if isinstance(uuid, str) else uuid
+            wanted = set(self.numbers[u] for u in uuids if u in self.numbers)
+
+        first = 0 if start is None else self._find(start)
+        last = self.entries if end is None else self._find(end)
+        for i in range(first, last):
+            ns, offset, number, stream = self._entry(i)
+            if stream not in streams or (wanted is not None and number not in wanted):
+                continue
+            info = self.processes[number]
+            yield (ns - self.origin) / 1e9, info["remote"], info["uuid"], stream, self._payload(offset)
+
+    def lines(self, uuid = None, start = None, end = None, stderr = True):
+        """
+        (seconds, remote, uuid, stream, line) for every line, a line carries the time its last chunk arrived
+        lines are split like Process splits them, a line cut by start is returned from where the range begins
+        """
+        readers = {}
+        streams = (STDOUT, STDERR) if stderr else (STDOUT,)
+        for t, remote, uuid_, stream, payload in self.chunks(uuid, start, end, streams + (EXIT,)):
+            if stream == EXIT:
+                for s in streams:
+                    reader = readers.pop((uuid_, s), None)
+                    if reader is not None:
+                        for line in reader.decode(True):
+                            yield t, remote, uuid_, s, line
+                continue
+
+            reader = readers.get((uuid_, stream))
+            if reader is None:
+                reader = remotemod.StreamReader()
+                readers[(uuid_, stream)] = reader
+            reader.scratch += payload
+            for line in reader.decode(False):
+                yield t, remote, uuid_, stream, line
+
+    def replay(self, listener, uuid = None, start = None, end = None, speed = None):
+        """
+        hand the recording to a Subscriber as if the processes were running
+        :param speed None as fast as possible, 1.0 in real time, 2.0 twice as fast, ...
+        """
+        readers = {}
+        began = time.monotonic()
+        first = None
+        for t, remote, uuid_, stream, payload in self.chunks(uuid, start, end):
+            if speed is not None:
+                first = t if first is None else first
+                delay = (t - first) / speed - (time.monotonic() - began)
+                if delay > 0:
+                    time.sleep(delay)
+
+            info = self.processes[self.numbers[uuid_]]
+            args = info["args"]
+            if stream == EXIT:
+                out = readers.pop((uuid_, STDOUT), None)
+                err = readers.pop((uuid_, STDERR), None)
+                if out is not None:
+                    lines = out.decode(True)
+                    if len(lines) > 0:
+                        listener.receive_out(remote, uuid_, args, lines)
+                if err is not None:
+                    lines = err.decode(True)
+                    if len(lines) > 0:
+                        listener.receive_err(remote, uuid_, args, lines)
+                listener.receive_status(remote, uuid_, args, EXITCODE.unpack(payload)[0])
+                continue
+
+            reader = readers.get((uuid_, stream))
+            if reader is None:
+                reader = remotemod.StreamReader()
+                readers[(uuid_, stream)] = reader
+            reader.scratch += payload
+            lines = reader.decode(False)
+            if len(lines) == 0:
+                continue
+            if stream == STDOUT:
+                listener.receive_out(remote, uuid_, args, lines)
+            else:
+                listener.receive_err(remote, uuid_, args, lines)
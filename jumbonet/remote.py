@@ -1,24 +1,84 @@
 from paramiko import SSHClient, AutoAddPolicy
-from paramiko.ssh_exception import  SSHException, BadHostKeyException
+from paramiko.ssh_exception import  SSHException, BadHostKeyException, ChannelException
+import codecs
+import collections
 import logging
+import queue
+import re
+import selectors
+import shlex
+import threading
+import time
 import traceback
 import uuid
 import socket
+from . import agent as agentmod
+from . import broker as brokermod
+from . import filters as filtersmod
+from . import metrics
+from . import output
+from . import sampler as samplermod
+from . import trace
 
 log = logging.getLogger(__name__)
 
-BUFFSIZE = 1024
+# bytes asked for per recv, a paramiko packet carries at most 32 KiB
+BUFFSIZE = 32768
+
+# holds a command back on an already opened channel until the controller sends "go <time>", see Master.broadcast
+# answers "t" with its clock so the controller can estimate the round trip time and clock offset
+GATE_SOURCE = r'''
+import os, sys, termios, time
+fd = sys.stdin.fileno()
+attrs = termios.tcgetattr(fd) if os.isatty(fd) else None
+if attrs is not None:
+    quiet = termios.tcgetattr(fd)
+    quiet[3] &= ~termios.ECHO
+    termios.tcsetattr(fd, termios.TCSANOW, quiet)
+print("r", flush = True)
+for line in sys.stdin:
+    if line.startswith("t"):
+        print("t %.9f" % time.time(), flush = True)
+    elif line.startswith("go"):
+        at = float(line.split()[1])
+        while True:
+            left = at - time.time()
+            if left <= 0:
+                break
+            time.sleep(left)
+        print("s %.9f" % time.time(), flush = True)
+        if attrs is not None:
+            termios.tcsetattr(fd, termios.TCSANOW, attrs)
+        os.execv("/bin/sh", ["/bin/sh", "-c", sys.argv[1]])
+'''
+
+# how often to look whether a queued process got its session
+EXIT_POLL = 0.001
+# bytes read from a file per write by Process.write_from
+STDIN_CHUNK = 1 << 20
+# ^D, ends the input of a command on a pty, which has no other way to see eof
+EOT = b"\x04"
+
+# ends the output of every command of a batch on stdout and stderr, followed by the batch token, index and exitcode
+BATCH_MARKER = "\x1ejumbonet-batch"
+
+# characters str.splitlines treats as line boundaries, \r is left out as it may be followed by \n in the next chunk
+LINEBREAKS = "\n\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"
+# anything str.splitlines splits at
+BREAKS = re.compile("[\r" + LINEBREAKS + "]")
 
 
 class Remote():
     def __init__(self, name, remote_host, remote_user, keyfile = None, remote_password = None, \
-                 port = 22, inband_interface = None, inband_ip = None, inband_mac = None, cmd_factory = None):
+                 port = 22, inband_interface = None, inband_ip = None, inband_mac = None, cmd_factory = None, timeout = None, \
+                 agent = False, max_sessions = None, broker = None):
         self.name = name
         self.user = remote_user
         self.host = remote_host
         self.port = port
         
-        self.ssh = SSHClient()
+        # a broker path (True for the default one) reuses a connection the broker daemon keeps open
+        self.ssh = SSHClient() if not broker else brokermod.BrokerClient(broker)
         self.ssh.set_missing_host_key_policy(AutoAddPolicy())
         self.connected = False
 
@@ -26,9 +86,16 @@ class Remote():
         self.inband_ip = inband_ip
         self.inband_mac = inband_mac
         self.cmds = cmd_factory
+        # set by the master to interrupt its mainloop whenever a process is started or killed
+        self.wakeup = None
+        # set by the master to hand listener callbacks to worker threads, None calls them inline
+        self.dispatcher = None
+        # set by the master to record the output of every process, see jumbonet.record
+        self.recorder = None
         
         try:
-            self.ssh.connect(self.host, port, remote_user, remote_password, key_filename = keyfile, look_for_keys=True)
+            self.ssh.connect(self.host, port, remote_user, remote_password, key_filename = keyfile, look_for_keys=True, \
+                             timeout = timeout, banner_timeout = timeout, auth_timeout = timeout)
             self.connected = True
             self.ssh.get_transport().set_keepalive(1)
         
@@ -40,6 +107,49 @@ class Remote():
             raise
         
         self.processes = []
+        # the processes that have not exited yet, what the mainloop watches instead of every process ever started
+        self.live = set()
+
+        # popen queues processes once max_sessions channels are in use and starts them as sessions free up
+        # if no limit is given, it is learned from the first session the sshd refuses
+        self.max_sessions = max_sessions
+        self.sessions = set()
+        self.launch_queue = collections.deque()
+        self.launch_lock = threading.RLock()
+        self.launched = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+        self.agent = None
+        if agent:
+            self.start_agent()
+        # a sampler.Sampler reading the load of the remote from /proc
+        self.sampler = None
+
+    def start_agent(self, interpreter = "python3"):
+        """
+        from now on start processes through a helper on the remote instead of one ssh channel each
+        requires a python3 interpreter on the remote
+        """
+        if self.agent is None or not self.agent.alive:
+            self.agent = agentmod.Agent(self, interpreter = interpreter)
+        return self.agent
+
+    def start_sampler(self, rate = 20, nics = None, flush = 0.1, interpreter = "python3"):
+        """
+        sample cpu, memory, softirq and nic counters on a channel of its own, see jumbonet.sampler
+        requires a python3 interpreter on the remote
+        """
+        self.stop_sampler()
+        self.sampler = samplermod.Sampler(self, rate = rate, nics = nics, flush = flush, interpreter = interpreter)
+        return self.sampler
+
+    def stop_sampler(self):
+        """stop sampling, returns the Sampler holding the samples or None if none was running"""
+        sampler, self.sampler = self.sampler, None
+        if sampler is not None:
+            sampler.stop()
+        return sampler
         
     def IP(self):
         return self.inband_ip
@@ -52,13 +162,69 @@ class Remote():
         return self.inband_interface
         
     
-    def popen(self, args, listener, wd = None, listen_output = False, listen_error = True, listen_status = True):
+    def popen(self, args, listener, wd = None, listen_output = False, listen_error = True, listen_status = True, \
+              bufsize = BUFFSIZE, retention = None, pty = True, stdout_to = None, stderr_to = None, \
+              filters = None, parser = None):
         """
         start a new process
         :param args a list of the command and its arguments
         :listener an instance of output listener to receive the out/err and status updates
+        :bufsize the number of bytes asked for per recv on the channel
+        :retention a factory for the containers of the stdout/stderr lines, see jumbonet.output
+        :pty run the command on a pty, which merges stderr into stdout and rewrites line endings
+             without one, stderr stays separate and the output is passed on as is, but a kill only closes the
+             channel instead of hanging up on the command, which ends once it next writes
+        :stdout_to, stderr_to pass the bytes of the stream as they arrive to a file (a path or anything with write)
+             or into a writable buffer instead of splitting them into lines, see output.sink, use with pty = False
+        :filters a list of steps from jumbonet.filters, run on the remote so only the lines they keep are sent
+        :parser a jumbonet.parsers.Parser fed the stdout lines as they arrive, its result is in p.parser.result()
         """
         assert(self.connected)
+        command = self.__command(args, wd)
+        if filters:
+            command = filtersmod.wrap(command, filters)
+        
+        p = Process(None, args, bufsize = bufsize, retention = retention, stdout_to = stdout_to, stderr_to = stderr_to)
+        p.command = command
+        p.pty = pty
+        p.parser = parser
+        p.remotename = self.name
+        p.wakeup = self.wakeup
+        if self.recorder is not None:
+            self.recorder.attach(p)
+        
+        p.listeners.append((listener, listen_output, listen_error, listen_status))
+
+        if self.agent is not None:
+            # agent processes share one session, there is nothing to queue for
+            p.start(self.agent.spawn(command, pty = pty))
+            metrics.PROCESSES_STARTED.inc(1, self.name)
+        else:
+            with self.launch_lock:
+                if len(self.launch_queue) == 0 and not self.__at_session_limit():
+                    try:
+                        p.start(self.__open_session(command, pty))
+                        self.__started(p)
+                    except (ChannelException, SSHException) as e:
+                        if len(self.sessions) == 0:
+                            raise
+                        self.__learn_session_limit(e)
+
+                if p.chan is None:
+                    self.launch_queue.append(p)
+                    trace.record(trace.QUEUED, p)
+                    log.debug("Queued %s @ %s with UUID:%s, %d waiting" %(command, self.name, p.uuid, len(self.launch_queue)))
+
+        self.processes.append(p)
+        self.live.add(p)
+        if self.wakeup is not None:
+            self.wakeup()
+        
+        log.debug("Started %s @ %s with UUID:%s via %s" %(command, self.name, p.uuid, p.chan))
+        
+        return p
+
+    def __command(self, args, wd):
         assert(len(args) > 0)
         
         cmd = []
@@ -68,23 +234,304 @@ class Remote():
         command = str.join(" ",cmd)
         
         assert(command != "")
-        
+        return command
+
+    def arm(self, args, listener, wd = None, listen_output = False, listen_error = True, listen_status = True, \
+            bufsize = BUFFSIZE, retention = None, interpreter = "python3", timeout = 10):
+        """
+        open the channel for a process but hold the command back until release(), see Master.broadcast
+        requires a python3 interpreter on the remote
+        """
+        assert(self.connected)
+        command = self.__command(args, wd)
+
         chan = self.ssh.get_transport().open_channel("session")
-        chan.setblocking(0)
+        chan.settimeout(timeout)
         chan.get_pty()
+        chan.exec_command("{} -c {} {}".format(interpreter, shlex.quote(GATE_SOURCE), shlex.quote(command)))
 
-        chan.exec_command(command)
-        p = Process(chan, args)
-        
+        p = Process(None, args, bufsize = bufsize, retention = retention)
+        p.command = command
+        p.remotename = self.name
+        p.wakeup = self.wakeup
+        if self.recorder is not None:
+            self.recorder.attach(p)
         p.listeners.append((listener, listen_output, listen_error, listen_status))
+        p.start(chan)
+        p.gate = bytearray()
 
+        try:
+            self.__gate_reply(p, "r")
+        except Exception:
+            chan.close()
+            raise
+        with self.launch_lock:
+            self.__started(p)
 
-        self.processes.append(p)
-        
-        log.debug("Started %s @ %s with UUID:%s via %s" %(command, self.name, p.uuid, p.chan))
-        
+        log.debug("Armed %s @ %s with UUID:%s via %s" %(command, self.name, p.uuid, p.chan))
         return p
+
+    def __gate_reply(self, p, kind):
+        """the rest of the next line the gate of an armed process answers with"""
+        while b"\n" not in p.gate:
+            read = p.chan.recv(256)
+            if len(read) == 0:
+                raise Exception("{} @ {} exited before it was released".format(p.command, self.name))
+            p.gate += read
+
+        line, _, rest = p.gate.partition(b"\n")
+        p.gate = bytearray(rest)
+        line = line.decode("utf-8").strip()
+        if not line.startswith(kind):
+            raise Exception("Unexpected answer from the gate of {} @ {}: {}".format(p.command, self.name, line))
+        return line[len(kind):].strip()
+
+    def probe_clock(self, p, samples = 5):
+        """
+        estimate round trip time and clock offset (remote - local) through the gate of an armed process
+        returns (rtt, offset) of the sample with the shortest round trip
+        """
+        best = None
+        for _ in range(samples):
+            t0 = time.time()
+            p.chan.sendall(b"t\n")
+            remote = float(self.__gate_reply(p, "t"))
+            t1 = time.time()
+
+            rtt = t1 - t0
+            if best is None or rtt < best[0]:
+                best = (rtt, remote - (t0 + t1) / 2)
+        return best
+
+    def release(self, p, at):
+        """let an armed process start at time at on the clock of the remote, returns immediately"""
+        p.chan.sendall("go {:.9f}\n".format(at).encode("utf-8"))
+
+    def await_start(self, p):
+        """
+        wait until a released process has started and hand it over to the mainloop
+        returns the time it started at on the clock of the remote
+        """
+        started = float(self.__gate_reply(p, "s"))
+
+        # whatever the command printed right away came along with the answer
+        p.stdout_reader.scratch += p.gate
+        p.gate = None
+        p.chan.setblocking(0)
+
+        self.processes.append(p)
+        self.live.add(p)
+        if self.wakeup is not None:
+            self.wakeup()
+        return started
+
+    def disarm(self, p):
+        """
+        kill an armed process because its broadcast failed
+        one that was not handed over to the mainloop yet is settled here and gives its session back
+        """
+        p.kill()
+        if p in self.processes:
+            return
+
+        p.gate = None
+        p.exitcode = -1
+        p.alive = False
+        with self.launch_lock:
+            self.sessions.discard(p)
+        self.launch_pending()
+
+    def __open_session(self, command, pty = True):
+        start = time.perf_counter()
+        chan = self.ssh.get_transport().open_channel("session")
+        chan.setblocking(0)
+        if pty:
+            chan.get_pty()
+
+        chan.exec_command(command)
+        metrics.CHANNEL_OPEN.observe(time.perf_counter() - start, self.name)
+        return chan
+
+    def __at_session_limit(self):
+        return self.max_sessions is not None and len(self.sessions) >= self.max_sessions
+
+    def __learn_session_limit(self, e):
+        self.max_sessions = max(1, len(self.sessions))
+        log.warning("{} refused a session ({}), limiting to {} concurrent sessions".format(self.name, e, self.max_sessions))
+
+    def __started(self, p):
+        self.sessions.add(p)
+        self.launched += 1
+        metrics.PROCESSES_STARTED.inc(1, self.name)
+        wait = p.wait_time()
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def launch_pending(self):
+        """start queued processes for as long as sessions are available"""
+        with self.launch_lock:
+            while len(self.launch_queue) > 0 and not self.__at_session_limit():
+                p = self.launch_queue[0]
+                if p.cancelled:
+                    self.launch_queue.popleft()
+                    continue
+
+                try:
+                    chan = self.__open_session(p.command, p.pty)
+                except (ChannelException, SSHException) as e:
+                    if len(self.sessions) > 0:
+                        self.__learn_session_limit(e)
+                        break
+                    log.error("Could not start {} @ {}: {}".format(p.command, self.name, e))
+                    self.launch_queue.popleft()
+                    p.cancelled = True
+                    continue
+
+                self.launch_queue.popleft()
+                p.start(chan)
+                self.__started(p)
+                log.debug("Started queued %s @ %s with UUID:%s after %.3fs" %(p.command, self.name, p.uuid, p.wait_time()))
+
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def probe_max_sessions(self, limit = 64):
+        """
+        find out how many more sessions the sshd grants by opening idle ones until it refuses
+        sets and returns max_sessions
+        """
+        probes = []
+        try:
+            while len(probes) < limit:
+                chan = None
+                try:
+                    chan = self.ssh.get_transport().open_channel("session")
+                    chan.exec_command("cat")
+                except (ChannelException, SSHException):
+                    # only the refused one, the probes before it were granted
+                    if chan is not None:
+                        chan.close()
+                    break
+                probes.append(chan)
+            # the sshd may also grant a session and close it right away
+            probes = [chan for chan in probes if not chan.closed]
+        finally:
+            for chan in probes:
+                chan.close()
+
+        with self.launch_lock:
+            self.max_sessions = len(self.sessions) + len(probes)
+        log.info("{} grants {} concurrent sessions".format(self.name, self.max_sessions))
+        self.launch_pending()
+        return self.max_sessions
+
+    def queue_depth(self):
+        """number of processes waiting for a session"""
+        return len(self.launch_queue)
+
+    def launch_stats(self):
+        with self.launch_lock:
+            return {"queued": len(self.launch_queue),
+                    "running": len(self.sessions),
+                    "max_sessions": self.max_sessions,
+                    "launched": self.launched,
+                    "mean_wait": self.total_wait / self.launched if self.launched > 0 else 0.0,
+                    "max_wait": self.max_wait}
     
+    def run_batch(self, commands, wd = None, stop_on_error = False, timeout = None):
+        """
+        run short commands one after the other through a single channel and wait for all of them
+        much cheaper than a popen per command for setup steps like ip, sysctl or tc
+        :param commands a list of commands, each a list of args like for popen or a string for the shell
+        :param wd the directory to run the commands in
+        :param stop_on_error skip the remaining commands once one fails
+        :param timeout seconds to wait for the whole batch, raises a TimeoutError
+        returns a CommandResult per command, those skipped have an exitcode of None
+        if the script dies before a command finishes, e.g. of a syntax error, that command gets the exit status of the
+        script (-1 if there is none) and its stderr
+        """
+        assert(self.connected)
+        token = uuid.uuid4().hex
+        marker = "{}-{}".format(BATCH_MARKER, token)
+
+        script = []
+        if wd is not None:
+            script.append("cd {} || exit 1".format(shlex.quote(wd)))
+        for i, command in enumerate(commands):
+            if not isinstance(command, str):
+                command = str.join(" ", command)
+            # a subshell each, like separate popens, an exit only ends its own command
+            # stdin stays off the script, which the shell is still reading
+            # the leading : keeps a command that is only a comment from leaving an empty subshell
+            script.append("( :\n{}\n) </dev/null".format(command))
+            script.append("rc=$?; printf '{0} {1} %d\\n' $rc; printf '{0} {1} %d\\n' $rc >&2".format(marker, i))
+            if stop_on_error:
+                script.append("[ $rc -eq 0 ] || exit $rc")
+        script.append("exit 0\n")
+
+        out = bytearray()
+        err = bytearray()
+        start = time.perf_counter()
+        chan = self.ssh.get_transport().open_channel("session")
+        try:
+            chan.exec_command("sh -s")
+            metrics.CHANNEL_OPEN.observe(time.perf_counter() - start, self.name)
+            chan.sendall(str.join("\n", script).encode("utf-8"))
+            chan.shutdown_write()
+
+            deadline = None if timeout is None else time.monotonic() + timeout
+            selector = selectors.DefaultSelector()
+            selector.register(chan, selectors.EVENT_READ)
+            try:
+                while True:
+                    if chan.recv_ready():
+                        out += chan.recv(BUFFSIZE)
+                    elif chan.recv_stderr_ready():
+                        err += chan.recv_stderr(BUFFSIZE)
+                    elif chan.closed or chan.eof_received:
+                        break
+                    else:
+                        remaining = None if deadline is None else deadline - time.monotonic()
+                        if remaining is not None and remaining <= 0:
+                            raise TimeoutError("Batch @ {} did not finish within {}s".format(self.name, timeout))
+                        selector.select(remaining)
+            finally:
+                selector.close()
+            status = chan.recv_exit_status()
+        finally:
+            chan.close()
+
+        results = [CommandResult(command) for command in commands]
+        pattern = re.compile(re.escape(marker.encode("utf-8")) + rb" (\d+) (-?\d+)\n")
+        rest = {}
+        for data, name in ((out, "stdout"), (err, "stderr")):
+            parts = pattern.split(bytes(data))
+            # chunk, index, exitcode, chunk, index, exitcode, ..., whatever came after the last command
+            for j in range(0, len(parts) - 1, 3):
+                result = results[int(parts[j + 1])]
+                result.exitcode = int(parts[j + 2])
+                reader = StreamReader()
+                reader.scratch += parts[j]
+                setattr(result, name, reader.decode(True))
+            rest[name] = parts[-1]
+
+        # unless stop_on_error skipped them, commands without a status mean the script itself died, e.g. of
+        # a syntax error or a failing cd to wd, the first of them gets its exit status and what came after the last one
+        unfinished = [result for result in results if result.exitcode is None]
+        stopped = stop_on_error and any(result.exitcode not in (None, 0) for result in results)
+        if len(unfinished) > 0 and not stopped:
+            result = unfinished[0]
+            result.exitcode = status if status != 0 else -1
+            for name, data in rest.items():
+                reader = StreamReader()
+                reader.scratch += data
+                setattr(result, name, reader.decode(True))
+            log.error("Batch @ {} ended at {} with {}: {}".format(self.name, result.command, status, \
+                      " ".join(result.stderr)))
+
+        log.debug("Batch of {} commands @ {} took {:.3f}s".format(len(commands), self.name, time.perf_counter() - start))
+        return results
+
     def get_process(self, uuid):
         for process in self.processes:
             if process.uuid == uuid:
@@ -94,22 +541,44 @@ class Remote():
     
     def check_processes(self):
         for process in self.processes:
-            if process.exitcode != None:
-                continue
-            
-            try:
-                (out, err, exited, exitcode) = process.read_outputs()
-                
-                for listener, wants_output, wants_error, wants_status in process.listeners:
-                    if wants_output and len(out) > 0:
-                        listener.receive_out(self.name, process.uuid, process.args, out)
-                    if wants_error and len(err) > 0:
-                        listener.receive_err(self.name, process.uuid, process.args, err)
-                    if wants_status and exited:
-                        listener.receive_status(self.name, process.uuid, process.args, exitcode)
-            
-            except:
-                traceback.print_exc()
+            self.check_process(process)
+
+    def check_process(self, process):
+        """read the outputs of one process and hand them to its listeners"""
+        if process.exitcode != None:
+            self.live.discard(process)
+            return
+        
+        start = time.perf_counter()
+        metrics.READS.inc(1, self.name)
+        try:
+            (out, err, exited, exitcode) = process.read_outputs()
+
+            if self.dispatcher is not None:
+                if len(out) > 0 or len(err) > 0 or exited:
+                    self.dispatcher.submit(self.name, process, out, err, exited, exitcode)
+            elif len(out) > 0 or len(err) > 0 or exited:
+                with metrics.LISTENER.time(self.name):
+                    for listener, wants_output, wants_error, wants_status in process.listeners:
+                        if wants_output and len(out) > 0:
+                            listener.receive_out(self.name, process.uuid, process.args, out)
+                        if wants_error and len(err) > 0:
+                            listener.receive_err(self.name, process.uuid, process.args, err)
+                        if wants_status and exited:
+                            listener.receive_status(self.name, process.uuid, process.args, exitcode)
+                if exited:
+                    trace.record(trace.DELIVERED, process, exitcode)
+        
+        except:
+            traceback.print_exc()
+        metrics.CHECK.observe(time.perf_counter() - start, self.name)
+
+        if process.exitcode is not None:
+            self.live.discard(process)
+        if process.exitcode is not None and process in self.sessions:
+            with self.launch_lock:
+                self.sessions.discard(process)
+            self.launch_pending()
             
             
     def kill(self, uuid):
@@ -135,8 +604,11 @@ class Remote():
         for process in self.processes:
             if process.exitcode == None:
                 process.kill()
-                process.chan.close()
                 
+        if self.agent is not None:
+            self.agent.close()
+
+        self.stop_sampler()
             
         self.ssh.close()
 
@@ -151,60 +623,311 @@ class Remote():
 
 
 
+class CommandResult():
+    """the outcome of one command of Remote.run_batch"""
+    def __init__(self, command):
+        self.command = command
+        self.exitcode = None # None if it did not run
+        self.stdout = []
+        self.stderr = []
+
+    @property
+    def ok(self):
+        return self.exitcode == 0
+
+    def __repr__(self):
+        return "CommandResult({}, exitcode {}, {} lines, {} errors)".format(self.command, self.exitcode, len(self.stdout), \
+                                                                           len(self.stderr))
+
+
 class Process():
-    def __init__(self, channel, args):
+    def __init__(self, channel, args, bufsize = BUFFSIZE, retention = None, stdout_to = None, stderr_to = None):
         self.uuid = uuid.uuid1().__str__()
         self.args = args
+        self.command = None
+        self.remotename = None
+        # a record.Recorder writing down the output of this process
+        self.recorder = None
         self.alive = True
         self.chan = channel
         self.listeners = []
-        self.stdout = []
-        self.stderr = []
+        self.wakeup = None
+        # a process without a channel is waiting for a session, cancelled if it gets killed while waiting
+        self.cancelled = False
+        self.queued_at = time.monotonic()
+        self.started_at = self.queued_at if channel is not None else None
+        if retention is None:
+            retention = output.keep_all()
+        self.stdout = retention()
+        self.stderr = retention()
+        self.pty = True
+        # a parsers.Parser fed the stdout lines, no longer fed after it raised
+        self.parser = None
+        self.parser_error = None
+        # streams passed on as bytes produce no lines
+        self.stdout_reader = StreamReader(bufsize) if stdout_to is None else BinaryReader(output.sink(stdout_to), bufsize)
+        self.stderr_reader = StreamReader(bufsize) if stderr_to is None else BinaryReader(output.sink(stderr_to), bufsize)
+        # queues of the iter_lines/wait_for callers, fed with (stream, line) and None once the process exited
+        self.followers = []
+        # what was written to stdin, see write
+        self.stdin_lock = threading.Lock()
+        self.stdin_bytes = 0
+        self.stdin_blocked = 0.0 # seconds spent waiting for the ssh window to open
+        self.stdin_started = None
+        self.stdin_last = None
+        self.stdin_closed = False
+        self.lock = threading.Lock()
         self.exitcode = None
         log.debug("New Process: %s as %s via %s" %(self.args, self.uuid, self.chan))
 
     def __str__(self):
         return "Process {}:{} alive: {} via {}, listeners: {}, exitcode: {}".format(self.uuid, self.args, self.alive, self.chan, self.listeners, self.exitcode)
 
+    def start(self, channel):
+        self.chan = channel
+        self.started_at = time.monotonic()
+        trace.record(trace.START, self)
+
+    def wait_time(self):
+        """seconds spent waiting for a session, so far if still queued"""
+        if self.started_at is None:
+            return time.monotonic() - self.queued_at
+        return self.started_at - self.queued_at
+
+    def follow(self, stderr = False, backlog = True):
+        """
+        a queue that receives every line from now on as (stream, line) and None once the process exited
+        :param backlog whether to start with the lines that were received already
+        """
+        q = queue.Queue()
+        with self.lock:
+            if backlog:
+                for line in self.stdout:
+                    q.put(("stdout", line))
+                if stderr:
+                    for line in self.stderr:
+                        q.put(("stderr", line))
+
+            if self.exitcode is not None:
+                q.put(None)
+            else:
+                self.followers.append(q)
+        return q
+
+    def unfollow(self, q):
+        with self.lock:
+            if q in self.followers:
+                self.followers.remove(q)
+
+    def iter_lines(self, timeout = None, block = True, stderr = False, backlog = True):
+        """
+        yield the lines of the process as they arrive until it exits, requires the mainloop to be running
+        :param timeout seconds to wait for the next line before raising TimeoutError
+        :param block if False only yield the lines that are available right now
+        :param stderr whether to include stderr lines (a process with a pty only has stdout)
+        :param backlog whether to start with the lines that were received already
+        """
+        q = self.follow(stderr = stderr, backlog = backlog)
+        try:
+            while True:
+                try:
+                    item = q.get(block, timeout)
+                except queue.Empty:
+                    if not block:
+                        return
+                    raise TimeoutError("No output from {} within {}s".format(self.args, timeout))
+
+                if item is None:
+                    return
+
+                stream, line = item
+                if stream == "stdout" or stderr:
+                    yield line
+        finally:
+            self.unfollow(q)
+
+    def wait_for(self, regex, timeout = None, stderr = False):
+        """
+        block until a line matches regex, e.g. wait_for("listening on port")
+        :param stderr whether to match stderr lines as well
+        returns the match, None if the process exits first or raises TimeoutError after timeout seconds
+        """
+        pattern = re.compile(regex)
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        q = self.follow(stderr = stderr)
+        try:
+            while True:
+                remaining = None if deadline is None else max(0, deadline - time.monotonic())
+                try:
+                    item = q.get(True, remaining)
+                except queue.Empty:
+                    raise TimeoutError("{} did not print {} within {}s".format(self.args, regex, timeout))
+
+                if item is None:
+                    return None
+
+                stream, line = item
+                if stream != "stdout" and not stderr:
+                    continue
+                match = pattern.search(line)
+                if match is not None:
+                    return match
+        finally:
+            self.unfollow(q)
+
+    def write(self, data, timeout = None):
+        """
+        send data to the stdin of the command, returns once all of it is sent
+        blocks while the ssh window is full, i.e. for as long as the command does not keep up reading
+        use pty = False with popen to stream data, a pty echoes it back and interprets control characters
+        :param data bytes, anything supporting the buffer protocol, or a str which is encoded as utf-8
+        :param timeout seconds to wait for the window to open (or a queued process to start) before a TimeoutError
+        returns the number of bytes written
+        """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        view = memoryview(data).cast("B")
+        if len(view) == 0:
+            return 0
+
+        with self.stdin_lock:
+            if self.stdin_closed:
+                raise OSError("stdin of {} is closed".format(self.args))
+            chan = self.__wait_started(timeout)
+
+            if self.stdin_started is None:
+                self.stdin_started = time.monotonic()
+            sent = 0
+            try:
+                while sent < len(view):
+                    try:
+                        n = chan.send(view[sent:])
+                    except socket.timeout:
+                        n = 0
+                    if n == 0:
+                        if chan.closed or chan.exit_status_ready() or self.exitcode is not None:
+                            raise OSError("{} is gone, {} of {} bytes written".format(self.args, sent, len(view)))
+                        self.__wait_window(chan, timeout)
+                        continue
+                    sent += n
+            finally:
+                # also what got out before a timeout or the command going away
+                if sent > 0:
+                    self.stdin_bytes += sent
+                    self.stdin_last = view[sent - 1]
+                    metrics.PROCESS_BYTES_SENT.inc(sent, self.remotename)
+            return sent
+
+    def write_from(self, source, close = False, timeout = None, chunk = STDIN_CHUNK):
+        """
+        write everything from source to stdin, see write
+        :param source a file opened in binary mode, a path, or an iterable of bytes or str
+        :param close whether to close stdin afterwards
+        returns the number of bytes written
+        """
+        written = 0
+        if isinstance(source, str):
+            with open(source, "rb") as f:
+                written = self.write_from(f, timeout = timeout, chunk = chunk)
+        elif hasattr(source, "readinto"):
+            buf = bytearray(chunk)
+            view = memoryview(buf)
+            while True:
+                n = source.readinto(buf)
+                if not n:
+                    break
+                written += self.write(view[:n], timeout = timeout)
+        elif hasattr(source, "read"):
+            while True:
+                data = source.read(chunk)
+                if not data:
+                    break
+                written += self.write(data, timeout = timeout)
+        else:
+            for data in source:
+                written += self.write(data, timeout = timeout)
+
+        if close:
+            self.close_stdin()
+        return written
+
+    def close_stdin(self):
+        """signal eof to the command, on a pty by sending ^D"""
+        with self.stdin_lock:
+            if self.stdin_closed:
+                return
+            chan = self.__wait_started(None)
+            self.stdin_closed = True
+            if chan.closed:
+                return
+            if self.pty:
+                # ^D only ends the input at the start of a line, the first one flushes a partial line
+                chan.sendall(EOT if self.stdin_last in (None, ord("\n")) else EOT + EOT)
+            chan.shutdown_write()
+
+    def bytes_received(self):
+        """bytes read from stdout and stderr so far"""
+        return {"stdout": self.stdout_reader.received, "stderr": self.stderr_reader.received}
+
+    def stdin_stats(self):
+        """bytes written to stdin, over how many seconds, the rate and how long writes waited for the window"""
+        with self.stdin_lock:
+            elapsed = 0.0 if self.stdin_started is None else time.monotonic() - self.stdin_started
+            return {"bytes": self.stdin_bytes,
+                    "seconds": elapsed,
+                    "megabytes_per_second": self.stdin_bytes / elapsed / 1e6 if elapsed > 0 else 0.0,
+                    "blocked_seconds": self.stdin_blocked}
+
+    def __wait_started(self, timeout):
+        """the channel, once a queued process got its session"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.chan is None:
+            if self.cancelled:
+                raise OSError("{} was killed before it started".format(self.args))
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError("{} did not start within {}s".format(self.args, timeout))
+            time.sleep(EXIT_POLL)
+        return self.chan
+
+    def __wait_window(self, chan, timeout):
+        start = time.monotonic()
+        # paramiko notifies this condition when the window is adjusted or the channel closes
+        cv = getattr(chan, "out_buffer_cv", None)
+        if cv is not None:
+            with cv:
+                if chan.out_window_size == 0 and not chan.closed and not chan.exit_status_ready():
+                    cv.wait(timeout)
+        else:
+            time.sleep(EXIT_POLL)
+        waited = time.monotonic() - start
+        self.stdin_blocked += waited
+        if timeout is not None and waited >= timeout:
+            raise TimeoutError("{} did not read its stdin within {}s".format(self.args, timeout))
+
     def kill(self):
-        self.chan.close()
+        trace.record(trace.KILL, self)
+        if self.chan is None:
+            self.cancelled = True
+        else:
+            self.chan.close()
+        if self.wakeup is not None:
+            self.wakeup()
             
     def _read_stdout(self, drain):
-        
-        scratch = ""
-        
-        try:
-            if drain or self.chan.recv_ready(): 
-                read = self.chan.recv(BUFFSIZE)
-                
-                while len(read) > 0:
-                    log.debug(read)
-                    scratch += read.decode("utf-8")
-                    read = self.chan.recv(BUFFSIZE)
-                
-        except socket.timeout:
-            pass
-        
-        return scratch.splitlines()
+        return self.stdout_reader.read(self.chan.recv, drain or self.chan.recv_ready(), drain)
     
     def _read_stderr(self, drain):
-        
-        scratch = ""
-        
-        try:
-            if drain or self.chan.recv_stderr_ready(): 
-                read = self.chan.recv_stderr(BUFFSIZE)
-                
-                while len(read) > 0:
-                    scratch += read.decode("utf-8")
-                    read = self.chan.recv_stderr(BUFFSIZE)
-                
-        except socket.timeout:
-            pass
-        
-        return scratch.splitlines()
+        return self.stderr_reader.read(self.chan.recv_stderr, drain or self.chan.recv_stderr_ready(), drain)
     
     def _read_liveness(self):
+        if self.chan is None:
+            if self.cancelled:
+                self.exitcode = -1
+                self.alive = False
+                return True, -1
+            return False, None
+
         if self.chan.exit_status_ready():
             exitcode = self.chan.recv_exit_status()
             self.exitcode = exitcode
@@ -220,14 +943,157 @@ class Process():
         log.debug("%s checking" %self.uuid)
         (exited, exitcode) = self._read_liveness()
         
-        out = self._read_stdout(exited)
-        err = self._read_stderr(exited)
-        
+        if self.chan is None:
+            out, err = [], []
+        else:
+            received = (self.stdout_reader.received, self.stderr_reader.received)
+            out = self._read_stdout(exited)
+            err = self._read_stderr(exited)
+            if self.stdout_reader.received > received[0]:
+                metrics.PROCESS_BYTES.inc(self.stdout_reader.received - received[0], self.remotename, "stdout")
+            if self.stderr_reader.received > received[1]:
+                metrics.PROCESS_BYTES.inc(self.stderr_reader.received - received[1], self.remotename, "stderr")
+            if len(out) > 0 or len(err) > 0:
+                trace.record(trace.OUTPUT, self, len(out) + len(err), \
+                             self.stdout_reader.received + self.stderr_reader.received - sum(received))
+        if exited:
+            trace.record(trace.EXIT, self, exitcode)
+            if self.recorder is not None:
+                self.recorder.exit(self, exitcode)
         
+
         log.debug("%s:\n-- stdout:%s\n-- stderr:%s" %(self.uuid, out, err))
         
-        self.stdout.extend(out)
-        self.stderr.extend(err)
+        with self.lock:
+            self.stdout.extend(out)
+            self.stderr.extend(err)
+
+            for q in self.followers:
+                for line in out:
+                    q.put(("stdout", line))
+                for line in err:
+                    q.put(("stderr", line))
+                if exited:
+                    q.put(None)
+            if exited:
+                self.followers = []
+
+        # after the lines are kept, a parser that raises must not cost them or the exit status
+        if self.parser is not None and self.parser_error is None:
+            try:
+                if len(out) > 0:
+                    self.parser.feed(out)
+                if exited:
+                    self.parser.close()
+            except Exception as e:
+                self.parser_error = e
+                log.error("Parser of {} @ {} failed, its output is not parsed anymore: {}".format(self.uuid, self.remotename, e))
+                traceback.print_exc()
+
+        if exited:
+            for lines in (self.stdout, self.stderr, self.stdout_reader, self.stderr_reader):
+                if hasattr(lines, "close"):
+                    lines.close()
         
         return out, err, exited, exitcode
         
+
+
+class StreamReader():
+    """
+    turns the chunks received on one stream of a channel into complete lines
+    bytes are gathered in a bytearray and decoded incrementally, so characters and lines that are
+    split across reads are carried over to the next read instead of being broken up
+    """
+    def __init__(self, bufsize = BUFFSIZE):
+        self.bufsize = bufsize
+        self.scratch = bytearray()
+        self.decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self.partial = [] # the pieces of the unfinished last line
+        self.received = 0 # bytes so far
+        # called with every chunk read before it is decoded, see jumbonet.record
+        self.sink = None
+
+    def read(self, recv, ready, final):
+        """
+        :param recv the recv function of the stream
+        :param ready whether there is anything to receive
+        :param final whether the stream has ended, flushes the incomplete last line
+        returns the lines completed by this read
+        """
+        scratch = self.scratch
+        try:
+            if ready:
+                read = recv(self.bufsize)
+                while len(read) > 0:
+                    scratch += read
+                    read = recv(self.bufsize)
+        except socket.timeout:
+            pass
+
+        if self.sink is not None and len(scratch) > 0:
+            self.sink(scratch)
+        self.received += len(scratch)
+        return self.decode(final)
+
+    def decode(self, final):
+        """the lines completed by the bytes in scratch"""
+        scratch = self.scratch
+        text = self.decoder.decode(scratch, final)
+        del scratch[:]
+
+        # only the new text is searched for line breaks, the unfinished line is joined once it is complete,
+        # so a long line arriving over many reads costs no more than a short one
+        # a trailing \r stays unfinished as it may be the first half of a \r\n
+        partial = self.partial
+        carriage = len(partial) > 0 and partial[-1].endswith("\r")
+        if not final and not carriage and BREAKS.search(text) is None:
+            if len(text) > 0:
+                partial.append(text)
+            return []
+
+        lines = text.splitlines(True)
+        if len(partial) > 0:
+            if carriage and not text.startswith("\n"):
+                lines.insert(0, "".join(partial))
+            elif len(lines) > 0:
+                lines[0] = "".join(partial) + lines[0]
+            else:
+                lines.append("".join(partial))
+        self.partial = []
+
+        if not final and len(lines) > 0:
+            last = lines[-1]
+            if last[-1] == "\r" or last[-1] not in LINEBREAKS:
+                self.partial.append(lines.pop())
+
+        return [line.splitlines()[0] for line in lines]
+
+
+class BinaryReader():
+    """passes the chunks received on one stream of a channel on to a sink as they are, see output.sink"""
+    def __init__(self, target, bufsize = BUFFSIZE):
+        self.target = target
+        self.bufsize = bufsize
+        self.received = 0 # bytes so far
+        # called with every chunk read, see jumbonet.record
+        self.sink = None
+
+    def read(self, recv, ready, final):
+        """same as StreamReader.read, returns no lines"""
+        write = self.target.write
+        try:
+            if ready:
+                read = recv(self.bufsize)
+                while len(read) > 0:
+                    if self.sink is not None:
+                        self.sink(read)
+                    write(read)
+                    self.received += len(read)
+                    read = recv(self.bufsize)
+        except socket.timeout:
+            pass
+        return []
+
+    def close(self):
+        self.target.close()
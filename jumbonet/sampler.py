@@ -0,0 +1,208 @@
+import array
+import json
+import logging
+import shlex
+import struct
+import threading
+
+log = logging.getLogger(__name__)
+
+# samples cpu, memory, softirq and per nic counters of a remote from /proc, over one long-lived ssh channel
+#   sampler = remote.start_sampler(rate = 20)      # or net.start_sampling(), Testcase does so on its own
+#   ...
+#   sampler = remote.stop_sampler()
+#   sampler["eth0.rx_bytes"], sampler["t"]          # typed arrays, one value per sample
+#   sampler.series().save("h1_load.npz")            # requires numpy
+#
+# counters (cpu jiffies, softirqs, nic bytes/packets/drops) are the delta since the previous sample,
+# mem_available_kb is the value at the time of the sample, t the time.time() of the remote
+# the helper on the remote requires a python3 interpreter, it sends a json header line with the column names
+# followed by one fixed size record per sample, several of them batched into a write every flush seconds
+
+CPU_COLUMNS = ("cpu_user", "cpu_nice", "cpu_system", "cpu_idle", "cpu_iowait", "cpu_irq", "cpu_softirq", "cpu_steal")
+SOFTIRQ_COLUMNS = ("softirq_net_rx", "softirq_net_tx")
+NIC_COLUMNS = ("rx_bytes", "rx_packets", "rx_drop", "tx_bytes", "tx_packets", "tx_drop")
+
+SAMPLER_SOURCE = r'''
+import json, os, struct, sys, time
+
+rate, flush = float(sys.argv[1]), float(sys.argv[2])
+wanted = json.loads(sys.argv[3])
+fds = {name: os.open("/proc/" + name, os.O_RDONLY) for name in ("stat", "meminfo", "softirqs", "net/dev")}
+
+def read(name):
+    return os.pread(fds[name], 1 << 20, 0)
+
+def netdev():
+    nics = {}
+    for line in read("net/dev").splitlines()[2:]:
+        name, _, values = line.partition(b":")
+        values = values.split()
+        nics[name.strip().decode()] = [int(values[i]) for i in (0, 1, 3, 8, 9, 11)]
+    return nics
+
+nics = sorted(netdev()) if wanted is None else wanted
+
+def counters():
+    cpu = [int(v) for v in read("stat").split(b"\n", 1)[0].split()[1:9]]
+    cpu += [0] * (8 - len(cpu))
+    softirqs = [0, 0]
+    for line in read("softirqs").splitlines():
+        name, _, values = line.partition(b":")
+        name = name.strip()
+        if name in (b"NET_RX", b"NET_TX"):
+            softirqs[name == b"NET_TX"] = sum(int(v) for v in values.split())
+    dev = netdev()
+    values = cpu + softirqs
+    for nic in nics:
+        values += dev.get(nic, [0] * 6)
+    return values
+
+def available():
+    for line in read("meminfo").splitlines():
+        if line.startswith(b"MemAvailable:"):
+            return int(line.split()[1])
+    return 0
+
+def total():
+    for line in read("meminfo").splitlines():
+        if line.startswith(b"MemTotal:"):
+            return int(line.split()[1])
+    return 0
+
+last = counters()
+record = struct.Struct("<d%dq" % (len(last) + 1))
+out = sys.stdout.buffer
+out.write(json.dumps({"nics": nics, "counters": len(last), "mem_total_kb": total(), "hz": os.sysconf("SC_CLK_TCK"), \
+                      "cpus": os.cpu_count(), "record": record.format}).encode() + b"\n")
+out.flush()
+
+interval = 1.0 / rate
+due = time.monotonic()
+flushed = due
+pending = []
+while True:
+    due += interval
+    now = time.monotonic()
+    if due > now:
+        time.sleep(due - now)
+    elif now - due > interval:
+        # fell behind, e.g. suspended, skip the missed samples instead of catching up
+        due = now
+    values = counters()
+    pending.append(record.pack(time.time(), *([v - l for v, l in zip(values, last)] + [available()])))
+    last = values
+    if time.monotonic() - flushed >= flush:
+        out.write(b"".join(pending))
+        out.flush()
+        pending = []
+        flushed = time.monotonic()
+'''
+
+
+class Sampler():
+    """
+    runs the sampling helper on its own channel of remote, a thread stores what arrives in typed arrays
+    :param rate samples per second
+    :param nics the interfaces to sample, default all the remote has when the sampler starts
+    :param flush the seconds samples are batched on the remote before they are sent
+    """
+    def __init__(self, remote, rate = 20, nics = None, flush = 0.1, interpreter = "python3", timeout = 10):
+        self.remote = remote
+        self.rate = rate
+        self.alive = True
+        self.received = 0 # bytes so far
+        self.lock = threading.Lock()
+
+        self.chan = remote.ssh.get_transport().open_channel("session")
+        self.chan.exec_command("{} -c {} {} {} {}".format(interpreter, shlex.quote(SAMPLER_SOURCE), rate, flush, \
+                                                          shlex.quote(json.dumps(nics))))
+        self.file = self.chan.makefile("rb")
+
+        # the header line tells the columns, a helper that fails to start closes the channel instead
+        self.chan.settimeout(timeout)
+        try:
+            header = self.file.readline()
+        except Exception as e:
+            self.chan.close()
+            raise Exception("Could not start the sampler @ {}: {}".format(remote.name, e))
+        if not header.endswith(b"\n"):
+            error = self.chan.recv_stderr(4096).decode("utf-8", "replace").strip() if self.chan.recv_stderr_ready() else ""
+            self.chan.close()
+            raise Exception("Could not start the sampler @ {}: {}".format(remote.name, error))
+        self.chan.settimeout(None)
+        self.received += len(header)
+
+        info = json.loads(header.decode("utf-8"))
+        self.nics = info["nics"]
+        self.mem_total_kb = info["mem_total_kb"]
+        self.hz = info["hz"]
+        self.cpus = info["cpus"]
+        self.record = struct.Struct(info["record"])
+        self.columns = list(CPU_COLUMNS + SOFTIRQ_COLUMNS) + \
+                       ["{}.{}".format(nic, column) for nic in self.nics for column in NIC_COLUMNS] + ["mem_available_kb"]
+        assert(len(self.columns) == info["counters"] + 1)
+        self.t = array.array("d")
+        self.values = [array.array("q") for _ in self.columns]
+
+        self.reader = threading.Thread(target = self._read_records, name = "jumbonet-sampler-{}".format(remote.name), \
+                                       daemon = True)
+        self.reader.start()
+        log.debug("Sampling @ %s at %sHz, nics %s" %(remote.name, rate, self.nics))
+
+    def __len__(self):
+        return len(self.t)
+
+    def __getitem__(self, name):
+        if name == "t":
+            return self.t
+        return self.values[self.columns.index(name)]
+
+    def keys(self):
+        return ["t"] + self.columns
+
+    def stop(self):
+        """close the channel, which ends the helper, and wait for what was sent until then"""
+        if self.alive:
+            self.alive = False
+            self.chan.close()
+        self.reader.join()
+        log.debug("Stopped sampling @ %s, %d samples in %d bytes" %(self.remote.name, len(self.t), self.received))
+        return self
+
+    def result(self):
+        """column name -> array, t first"""
+        with self.lock:
+            return {name: self[name] for name in self.keys()}
+
+    def series(self):
+        """the samples as a parsers.Series of numpy arrays, requires numpy"""
+        from . import parsers
+        parsers._require_numpy()
+        with self.lock:
+            columns = {name: parsers.numpy.array(self[name]) for name in self.keys()}
+        return parsers.Series(columns)
+
+    def save(self, path):
+        return self.series().save(path)
+
+    def _read_records(self):
+        size = self.record.size
+        try:
+            while True:
+                data = self.file.read(size)
+                if len(data) < size:
+                    break
+                self.received += size
+                sample = self.record.unpack(data)
+                with self.lock:
+                    self.t.append(sample[0])
+                    for values, value in zip(self.values, sample[1:]):
+                        values.append(value)
+        except Exception as e:
+            if self.alive:
+                log.error("Sampler @ {} failed: {}".format(self.remote.name, e))
+
+        if self.alive:
+            log.warning("Sampler @ {} ended unexpectedly".format(self.remote.name))
+        self.alive = False
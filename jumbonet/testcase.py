@@ -1,68 +1,370 @@
+import collections
 import logging
+import lzma
+from multiprocessing.pool import ThreadPool
+import shlex
+import shutil
+import threading
 import traceback
 import time
 import sys
 import pathlib
-import subprocess
 import datetime
+import zlib
 from . import master
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 log = logging.getLogger(__name__)
 
+COLLECT_CHUNK = 1 << 20
+
+# compressors for Local.collect(compress = ...), in the order "auto" prefers them: name -> (remote command, suffix)
+COMPRESSORS = collections.OrderedDict([
+    ("zstd", ("zstd -c -q", ".zst")),
+    ("xz", ("xz -c -T0", ".xz")),
+    ("gzip", ("gzip -c", ".gz")),
+])
+
 
 class Local():
     
     def __init__(self, net, experiment_root):
         self.experiment_root = experiment_root
         self.run = datetime.datetime.now()
-        self.to_collect = [] #(remote, filename)
+        self.to_collect = [] #(remote, location, filename)
+        self.collected = [] # per file transfer stats
+        self.followers = {} # remote name -> LiveCollector
         log.info("Experiment root is set to: {}".format(experiment_root))
 
     def mark(self, remote, filename, location):
         log.debug("Marked {} at {} for collection".format(filename, remote))
         self.to_collect.append((remote, location, filename))
 
-    @staticmethod
-    def check_scps(scps):
-        """ returns True if all have a returncode, else False """
-        log.debug("Checking {}".format(scps))
-        for scp in scps:
-            if scp.poll() is None:
-                return False
-
-        return True
-
-    def collect(self):
-        """ blocks while waiting for scp to complete"""
+    def run_dir(self):
+        """the local directory the files of this run are collected to"""
         p = pathlib.Path(self.experiment_root)
-        if not p.exists():
-            p.mkdir()
+        # the followers of several remotes may get here at the same time
+        p.mkdir(parents = True, exist_ok = True)
         m = p.joinpath(self.run.strftime("%y-%m-%d_%H-%M-%S"))
-        m.mkdir()
-        
-        scps = []
+        m.mkdir(exist_ok = True)
+        return m
 
-        for remote, location, filename in self.to_collect:
+    def follow(self, interval = 1.0):
+        """
+        copy what is appended to the marked files while the experiment is still running
+        collect() stops following and only has to transfer what was added since the last pass
+        """
+        remotes = dict((remote.name, remote) for remote, _, _ in self.to_collect)
+        for name, remote in remotes.items():
+            if name not in self.followers:
+                self.followers[name] = LiveCollector(self, remote, interval)
+                self.followers[name].start()
+
+    def stop_following(self):
+        for follower in self.followers.values():
+            follower.stop()
+        self.followers = {}
+
+    def collect(self, max_transfers = 8, per_remote = 4, resume = True, compress = None, decompress = True):
+        """
+        blocks while copying the marked files over the remotes' existing ssh connections
+        :param max_transfers the number of files in flight across all remotes
+        :param per_remote the number of files in flight per remote
+        :param resume continue partially copied files (e.g. from an aborted collect) instead of starting over
+        :param compress None to copy the files as they are over sftp, or "gzip", "xz", "zstd" or "auto" (the best
+            one the remote has) to stream them through that compressor on the remote
+        :param decompress whether compressed files are decompressed on arrival or stored with the compressor's suffix
+        returns a dict per file with bytes copied, seconds taken and throughput
+        """
+        self.stop_following()
+        m = self.run_dir()
+        if len(self.to_collect) == 0:
+            return []
+
+        # files are started one remote after the other, on whichever remote is next to have a slot free, so a remote
+        # with many files does not hold up the others while no more than max_transfers are in flight overall
+        # every slot of a remote is a transfer in flight
+        # paramiko's SFTPClient does not cope with concurrent transfers, so every slot gets its own
+        tasks = collections.OrderedDict() # remote name -> deque of (index, remote, path, local)
+        for i, (remote, location, filename) in enumerate(self.to_collect):
             log.info("Collecting {} from {}@{} to {}".format(filename, remote.user, remote.host, m))
-            scp = subprocess.Popen(["/usr/bin/scp", "{}@{}:{}/{}".format(remote.user, remote.host, location, filename),"{}_{}".format(remote.name, filename)],
-                                   cwd="{}".format(m),
-                                   stdout=subprocess.PIPE, stderr =subprocess.PIPE, stdin = None, shell=False)
-            scps.append(scp)
+            local = m.joinpath("{}_{}".format(remote.name, filename))
+            path = "{}/{}".format(location, filename)
+            tasks.setdefault(remote.name, collections.deque()).append((i, remote, path, local))
+
+        free = {} # remote name -> SFTPClients or compressor names not in use
+        try:
+            for name, files in tasks.items():
+                remote = files[0][1]
+                method = self.compressor(remote, compress, decompress) if compress is not None else None
+                free[name] = [remote.ssh.open_sftp() if method is None else method \
+                              for _ in range(min(per_remote, len(files)))]
+
+            fetch = self._fetch if compress is None else self._stream
+            outcomes = [None] * len(self.to_collect) # result dict or exception per file
+            slots = sum(len(s) for s in free.values())
+            done = threading.Condition()
+
+            def transfer(name, slot, i, remote, path, local):
+                try:
+                    outcomes[i] = fetch(remote, slot, path, local, resume, decompress)
+                except Exception as e:
+                    outcomes[i] = e
+                finally:
+                    with done:
+                        free[name].append(slot)
+                        done.notify()
+
+            names = list(tasks)
+            turn = 0
+            pool = ThreadPool(processes = min(max_transfers, slots))
+            try:
+                with done:
+                    while any(tasks.values()):
+                        ready = [k for k in range(len(names)) \
+                                 if tasks[names[(turn + k) % len(names)]] and free[names[(turn + k) % len(names)]]]
+                        if len(ready) == 0 or slots - sum(len(s) for s in free.values()) >= max_transfers:
+                            done.wait()
+                            continue
+                        name = names[(turn + ready[0]) % len(names)]
+                        turn = (turn + ready[0] + 1) % len(names)
+                        pool.apply_async(transfer, (name, free[name].pop()) + tasks[name].popleft())
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            if compress is None:
+                for clients in free.values():
+                    for client in clients:
+                        client.close()
+
+        results = []
+        for outcome in outcomes:
+            if isinstance(outcome, Exception):
+                log.error("Collection failed: {}".format(outcome))
+            else:
+                results.append(outcome)
+
+        self.collected.extend(results)
+        total = sum(r["bytes"] for r in results)
+        log.info("Collection done, {} of {} files, {:.1f} MB".format(len(results), len(self.to_collect), total / 1e6))
+        return results
+
+    @staticmethod
+    def compressor(remote, compress, decompress = True):
+        """pick the compressor to use for remote, resolving "auto" to the best one available on both ends"""
+        if compress != "auto":
+            if compress not in COMPRESSORS:
+                raise Exception("Unknown compressor {}, use one of {} or auto".format(compress, ", ".join(COMPRESSORS)))
+            if compress == "zstd" and decompress and zstandard is None:
+                raise Exception("Decompressing zstd requires the zstandard module")
+            return compress
+
+        chan = remote.ssh.get_transport().open_session()
+        chan.exec_command(" ; ".join("command -v {} >/dev/null && echo {}".format(name, name) for name in COMPRESSORS))
+        available = chan.makefile("rb").read().decode("utf-8").split()
+        chan.close()
+
+        for name in COMPRESSORS:
+            if name not in available:
+                continue
+            if name == "zstd" and decompress and zstandard is None:
+                continue
+            log.debug("Compressing with {} on {}".format(name, remote.name))
+            return name
+
+        raise Exception("No usable compressor on {}".format(remote.name))
+
+    @staticmethod
+    def _decompressor(method):
+        if method == "gzip":
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if method == "xz":
+            return lzma.LZMADecompressor()
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    @staticmethod
+    def _fetch(remote, sftp, path, local, resume, decompress):
+        size = sftp.stat(path).st_size
+        offset = 0
+        if resume and local.exists() and local.stat().st_size <= size:
+            offset = local.stat().st_size
+
+        start = time.monotonic()
+        with sftp.open(path, "rb") as rf, open(str(local), "ab" if offset > 0 else "wb") as lf:
+            rf.seek(offset)
+            # keeps many read requests in flight instead of one round trip per chunk
+            rf.prefetch(size)
+            while True:
+                data = rf.read(COLLECT_CHUNK)
+                if len(data) == 0:
+                    break
+                lf.write(data)
+        elapsed = time.monotonic() - start
+
+        copied = size - offset
+        rate = copied / elapsed if elapsed > 0 else 0.0
+        log.info("-- {}:{} {:.1f} MB in {:.2f}s ({:.1f} MB/s{})".format(remote.name, path, copied / 1e6, elapsed, rate / 1e6, \
+                 ", resumed at {}".format(offset) if offset > 0 else ""))
+        return {"remote": remote.name, "path": path, "local": str(local), "bytes": copied, "resumed_at": offset, \
+                "seconds": elapsed, "rate": rate}
+
+    @classmethod
+    def _stream(cls, remote, method, path, local, resume, decompress):
+        """copy one file by piping it through a compressor on the remote, written to disk as it arrives"""
+        command, suffix = COMPRESSORS[method]
+        if not decompress:
+            local = local.with_name(local.name + suffix)
+
+        # only uncompressed files can be resumed, appending to a compressed one would need the remote offset
+        offset = 0
+        if resume and decompress and local.exists():
+            offset = local.stat().st_size
+
+        if offset > 0:
+            # the pipeline would report the compressor's status only, a missing file has to fail the redirect instead
+            command = "exec < {} && tail -c +{} | {}".format(shlex.quote(path), offset + 1, command)
+        else:
+            command = "{} < {}".format(command, shlex.quote(path))
+
+        start = time.monotonic()
+        wire = 0
+        written = 0
+        decompressor = cls._decompressor(method) if decompress else None
+
+        # written next to local and only moved over (or appended to) it once the remote succeeded,
+        # a missing or failing file must not truncate what an earlier run already copied
+        partial = local.with_name(local.name + ".jumbonet-partial")
+        chan = remote.ssh.get_transport().open_session()
+        try:
+            chan.exec_command(command)
+            with open(str(partial), "wb") as lf:
+                while True:
+                    data = chan.recv(COLLECT_CHUNK)
+                    if len(data) == 0:
+                        break
+                    wire += len(data)
+                    if decompressor is not None:
+                        data = decompressor.decompress(data)
+                    written += len(data)
+                    lf.write(data)
+
+            exitcode = chan.recv_exit_status()
+            if exitcode != 0:
+                error = chan.recv_stderr(4096).decode("utf-8", "replace").strip()
+                raise Exception("Compressing {} on {} failed ({}): {}".format(path, remote.name, exitcode, error))
+
+            if offset > 0:
+                with open(str(partial), "rb") as pf, open(str(local), "ab") as lf:
+                    shutil.copyfileobj(pf, lf, COLLECT_CHUNK)
+                partial.unlink()
+            else:
+                partial.replace(local)
+        finally:
+            chan.close()
+            if partial.exists():
+                partial.unlink()
+        elapsed = time.monotonic() - start
+
+        if not decompress:
+            # the size of the original is only known to the remote, ask for it after the fact
+            chan = remote.ssh.get_transport().open_session()
+            chan.exec_command("wc -c < {}".format(shlex.quote(path)))
+            raw = int(chan.makefile("rb").read().decode("utf-8").strip() or 0)
+            chan.close()
+        else:
+            raw = written
+
+        ratio = raw / wire if wire > 0 else 0.0
+        rate = wire / elapsed if elapsed > 0 else 0.0
+        log.info("-- {}:{} {:.1f} MB as {:.1f} MB {} (ratio {:.2f}) in {:.2f}s ({:.1f} MB/s{})".format(remote.name, path, \
+                 raw / 1e6, wire / 1e6, method, ratio, elapsed, rate / 1e6, ", resumed at {}".format(offset) if offset > 0 else ""))
+        return {"remote": remote.name, "path": path, "local": str(local), "bytes": raw, "resumed_at": offset, \
+                "seconds": elapsed, "rate": rate, "compression": method, "wire_bytes": wire, "ratio": ratio}
 
-        #returns true if all scp commands are done
-        while not self.check_scps(scps):
-            time.sleep(0.5)
 
-        log.info("Collection done")
+class LiveCollector():
+    """tails the marked files of one remote into the run directory over sftp"""
+    def __init__(self, local, remote, interval):
+        self.local = local
+        self.remote = remote
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.copied = 0
+        self.thread = threading.Thread(target = self.run, name = "jumbonet-follow-{}".format(remote.name), daemon = True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        log.debug("Following the marked files on {}".format(self.remote.name))
+        sftp = None
+        try:
+            m = self.local.run_dir()
+            sftp = self.remote.ssh.open_sftp()
+            while not self.stopped.is_set():
+                for remote, location, filename in list(self.local.to_collect):
+                    if remote is not self.remote or self.stopped.is_set():
+                        continue
+                    self.tail(sftp, "{}/{}".format(location, filename), m.joinpath("{}_{}".format(remote.name, filename)))
+                self.stopped.wait(self.interval)
+        except:
+            log.error("Following the marked files on {} failed".format(self.remote.name))
+            traceback.print_exc()
+        finally:
+            if sftp is not None:
+                sftp.close()
+        log.debug("Stopped following {}, {:.1f} MB copied".format(self.remote.name, self.copied / 1e6))
+
+    def tail(self, sftp, path, local):
+        try:
+            size = sftp.stat(path).st_size
+        except IOError:
+            # not created yet
+            return
+
+        have = local.stat().st_size if local.exists() else 0
+        if size < have:
+            # truncated or replaced, start over
+            have = 0
+            local.unlink()
+        if size == have:
+            return
+
+        with sftp.open(path, "rb") as rf, open(str(local), "ab") as lf:
+            rf.seek(have)
+            rf.prefetch(size)
+            left = size - have
+            while left > 0:
+                data = rf.read(min(left, COLLECT_CHUNK))
+                if len(data) == 0:
+                    break
+                lf.write(data)
+                left -= len(data)
+                self.copied += len(data)
 
         
 class Testcase(master.Subscriber):
     
-    def __init__(self, allow_errors = False):
+    def __init__(self, allow_errors = False, broker = None, sample_rate = 10):
+        """
+        :param broker connect the remotes through the jumbonet.broker on this socket (True for the default one)
+        :param sample_rate samples per second of the load of every remote while test runs, None to not sample
+        """
         self.allow_errors = allow_errors
-        self.net = master.Master()
+        self.net = master.Master(broker = broker)
         self.net.mainloop()
         self.exit_handlers = {}
+        self.sample_rate = sample_rate
+        self.samples = {} # remote name -> sampler.Sampler, once test is done
 
     def exit_handler(self, process, cmd):
         log.debug("Exit handler registered: {} : {}".format(process.uuid, cmd))
@@ -104,9 +406,20 @@ class Testcase(master.Subscriber):
     def postprocess(self):
         raise NotImplementedError("Postprocessing not implemented")
     
+    def start_sampling(self):
+        if self.sample_rate is not None:
+            self.net.start_sampling(rate = self.sample_rate)
+
+    def stop_sampling(self):
+        self.samples.update(self.net.stop_sampling())
+
     def run(self, postprocessing = False):
         try:
-            self.test()
+            self.start_sampling()
+            try:
+                self.test()
+            finally:
+                self.stop_sampling()
             if postprocessing:
                 self.net.kill_all_processes()
                 # triggers exit handlers
@@ -0,0 +1,172 @@
+import array
+import itertools
+import json
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# a timeline of what the processes on all remotes did, viewable in chrome://tracing or https://ui.perfetto.dev
+#   trace.start()
+#   ... run the experiment ...
+#   trace.stop().export("timeline.json")
+# every remote becomes a track (a trace process), every jumbonet process a slice on a row of its own, from its
+# channel being opened until its exit status was read, with its output, kill and listener delivery marked on it
+#
+# recording costs a few array stores per event, into buffers allocated upfront, nothing is recorded unless started
+
+QUEUED = 0 # popen had to wait for a session
+START = 1 # the channel is open and the command runs
+OUTPUT = 2 # a read returned lines, value is their number
+KILL = 3
+EXIT = 4 # the exit status was read, value is the exitcode
+DELIVERED = 5 # the listeners have been handed the exit status
+
+TRACER = None
+
+
+def start(capacity = 1 << 20):
+    """start recording into a new Tracer holding up to capacity events"""
+    global TRACER
+    TRACER = Tracer(capacity)
+    return TRACER
+
+
+def stop():
+    """stop recording, returns the Tracer"""
+    global TRACER
+    tracer, TRACER = TRACER, None
+    return tracer
+
+
+def record(kind, process, value = 0, nbytes = 0):
+    tracer = TRACER
+    if tracer is not None:
+        tracer.record(kind, process, value, nbytes)
+
+
+class Tracer():
+    """
+    events go into preallocated arrays, a slot is claimed with a lock free counter
+    once capacity events are recorded, further events are counted in dropped and otherwise ignored
+    """
+    def __init__(self, capacity = 1 << 20):
+        self.capacity = capacity
+        self.times = array.array("q", bytes(8 * capacity)) # perf_counter_ns
+        self.kinds = array.array("B", bytes(capacity))
+        self.procs = array.array("I", bytes(4 * capacity)) # index into processes
+        self.values = array.array("q", bytes(8 * capacity))
+        self.nbytes = array.array("Q", bytes(8 * capacity))
+        self.slots = itertools.count()
+        self.dropped = 0
+        self.processes = [] # (remote name, uuid, args)
+        self.index = {} # uuid -> index into processes
+        self.lock = threading.Lock()
+        # perf_counter_ns is what is recorded, time.time() is kept to place the trace in wall clock time
+        self.origin = time.perf_counter_ns()
+        self.wallclock = time.time()
+
+    def record(self, kind, process, value = 0, nbytes = 0):
+        now = time.perf_counter_ns()
+        i = next(self.slots)
+        if i >= self.capacity:
+            with self.lock:
+                self.dropped += 1
+            return
+
+        p = self.index.get(process.uuid)
+        if p is None:
+            with self.lock:
+                p = self.index.get(process.uuid)
+                if p is None:
+                    p = len(self.processes)
+                    self.processes.append((process.remotename, process.uuid, process.args))
+                    self.index[process.uuid] = p
+
+        self.kinds[i] = kind
+        self.procs[i] = p
+        self.values[i] = value
+        self.nbytes[i] = nbytes
+        # last, a slot with a time is complete
+        self.times[i] = now
+
+    def events(self):
+        """(seconds since the start of the trace, kind, (remote, uuid, args), value, bytes) ordered by time"""
+        times = self.times
+        order = sorted((i for i in range(self.capacity) if times[i] != 0), key = times.__getitem__)
+        for i in order:
+            yield (self.times[i] - self.origin) / 1e9, self.kinds[i], self.processes[self.procs[i]], self.values[i], \
+                  self.nbytes[i]
+
+    def chrome_trace(self):
+        """the events in the chrome trace event format, as a dict ready for json"""
+        remotes = {} # remote name -> trace pid
+        out = []
+
+        def us(seconds):
+            return round(seconds * 1e6, 3)
+
+        def pid_of(remote):
+            if remote not in remotes:
+                remotes[remote] = len(remotes) + 1
+                out.append({"ph": "M", "name": "process_name", "pid": remotes[remote], "tid": 0, \
+                            "args": {"name": str(remote)}})
+            return remotes[remote]
+
+        named = set()
+        open_slices = {} # process index -> (kind, start)
+        for t, kind, (remote, uuid, args), value, nbytes in self.events():
+            pid = pid_of(remote)
+            tid = self.index[uuid] + 1
+            if tid not in named:
+                named.add(tid)
+                out.append({"ph": "M", "name": "thread_name", "pid": pid, "tid": tid, \
+                            "args": {"name": " ".join(str(a) for a in args)}})
+
+            name = " ".join(str(a) for a in args)
+            if kind == QUEUED:
+                open_slices[tid] = ("queued", t)
+            elif kind == START:
+                if tid in open_slices:
+                    _, begin = open_slices.pop(tid)
+                    out.append({"ph": "X", "name": "waiting for a session", "cat": "queue", "pid": pid, "tid": tid, \
+                                "ts": us(begin), "dur": us(t - begin)})
+                open_slices[tid] = ("run", t)
+            elif kind == OUTPUT:
+                out.append({"ph": "i", "s": "t", "name": "output", "cat": "output", "pid": pid, "tid": tid, "ts": us(t), \
+                            "args": {"lines": value, "bytes": nbytes}})
+            elif kind == KILL:
+                out.append({"ph": "i", "s": "t", "name": "kill", "cat": "kill", "pid": pid, "tid": tid, "ts": us(t)})
+            elif kind == EXIT:
+                state, begin = open_slices.pop(tid, ("run", t))
+                out.append({"ph": "X", "name": name, "cat": "process", "pid": pid, "tid": tid, "ts": us(begin), \
+                            "dur": us(t - begin), "args": {"uuid": uuid, "exitcode": value}})
+                open_slices[tid] = ("exit", t)
+            elif kind == DELIVERED:
+                state, begin = open_slices.pop(tid, ("exit", t))
+                out.append({"ph": "X", "name": "exit handling", "cat": "listener", "pid": pid, "tid": tid, \
+                            "ts": us(begin), "dur": us(t - begin), "args": {"exitcode": value}})
+
+        # processes still running when the trace was taken
+        end = (time.perf_counter_ns() - self.origin) / 1e9
+        for tid, (state, begin) in open_slices.items():
+            if state == "exit":
+                # nobody listens for its exit status
+                continue
+            remote, uuid, args = self.processes[tid - 1]
+            name = " ".join(str(a) for a in args) if state == "run" else state
+            out.append({"ph": "X", "name": name, "cat": "unfinished", "pid": remotes[remote], "tid": tid, \
+                        "ts": us(begin), "dur": us(end - begin), "args": {"uuid": uuid}})
+
+        return {"traceEvents": out, "displayTimeUnit": "ms", \
+                "otherData": {"wallclock_origin": self.wallclock, "dropped_events": self.dropped}}
+
+    def export(self, path):
+        """write the trace to path, open it in chrome://tracing or ui.perfetto.dev"""
+        trace = self.chrome_trace()
+        with open(path, "w") as f:
+            json.dump(trace, f)
+        log.info("Wrote {} trace events to {}{}".format(len(trace["traceEvents"]), path, \
+                 ", {} events dropped".format(self.dropped) if self.dropped > 0 else ""))
+        return path
@@ -0,0 +1,144 @@
+import logging
+import socket
+import threading
+from paramiko import pipe
+from paramiko.buffered_pipe import BufferedPipe, PipeTimeout
+from paramiko.channel import ChannelFile
+
+log = logging.getLogger(__name__)
+
+# bytes sent towards the stdin of a command before the other end confirms they were written, like an ssh window
+STDIN_WINDOW = 2 << 20
+
+
+class VirtualChannel():
+    """
+    stands in for a paramiko channel whose data does not arrive on a channel of its own
+    implements just as much of paramiko.Channel as the Process, the Master and SFTPClient rely on,
+    subclasses feed in_buffer/in_stderr_buffer, call _set_exited and react to close in _on_close
+    """
+    def __init__(self):
+        self.in_buffer = BufferedPipe()
+        self.in_stderr_buffer = BufferedPipe()
+        self.status_event = threading.Event()
+        self.exit_status = -1
+        self.closed = False
+        self.eof_received = False
+        self.timeout = None
+        self._pipe = None
+        self.lock = threading.Lock()
+        # the same names paramiko uses, Process.write waits on them
+        self.out_window_size = STDIN_WINDOW
+        self.out_buffer_cv = threading.Condition()
+
+    def get_name(self):
+        return str(self)
+
+    def setblocking(self, blocking):
+        self.timeout = None if blocking else 0
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def fileno(self):
+        with self.lock:
+            if self._pipe is None:
+                self._pipe = pipe.make_pipe()
+                p1, p2 = pipe.make_or_pipe(self._pipe)
+                self.in_buffer.set_event(p1)
+                self.in_stderr_buffer.set_event(p2)
+            return self._pipe.fileno()
+
+    def makefile(self, *params):
+        return ChannelFile(*([self] + list(params)))
+
+    def recv(self, nbytes):
+        try:
+            return self.in_buffer.read(nbytes, self.timeout)
+        except PipeTimeout:
+            raise socket.timeout()
+
+    def recv_stderr(self, nbytes):
+        try:
+            return self.in_stderr_buffer.read(nbytes, self.timeout)
+        except PipeTimeout:
+            raise socket.timeout()
+
+    def recv_ready(self):
+        return self.in_buffer.read_ready()
+
+    def recv_stderr_ready(self):
+        return self.in_stderr_buffer.read_ready()
+
+    def exit_status_ready(self):
+        return self.closed or self.status_event.is_set()
+
+    def recv_exit_status(self):
+        self.status_event.wait()
+        return self.exit_status
+
+    def _reserve(self, n):
+        """
+        wait for window as long as the timeout says, like paramiko's send, returns how much of n may be sent
+        raises socket.timeout if there is none and OSError once the channel is closed or the command exited
+        """
+        with self.out_buffer_cv:
+            if self.out_window_size == 0 and self.timeout != 0:
+                self.out_buffer_cv.wait_for(lambda: self.out_window_size > 0 or self.closed or \
+                                            self.status_event.is_set(), self.timeout)
+            if self.closed or (self.out_window_size == 0 and self.status_event.is_set()):
+                raise OSError("Socket is closed")
+            if self.out_window_size == 0:
+                raise socket.timeout()
+            n = min(n, self.out_window_size)
+            self.out_window_size -= n
+            return n
+
+    def _open_window(self, n):
+        """the other end wrote n bytes"""
+        with self.out_buffer_cv:
+            self.out_window_size += n
+            self.out_buffer_cv.notify_all()
+
+    def _wake_writers(self):
+        with self.out_buffer_cv:
+            self.out_buffer_cv.notify_all()
+
+    def sendall(self, data):
+        view = memoryview(data).cast("B")
+        while len(view) > 0:
+            view = view[self.send(view):]
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.status_event.set()
+            self.in_buffer.close()
+            self.in_stderr_buffer.close()
+            if self._pipe is not None:
+                self._pipe.close()
+                self._pipe = None
+
+        self._wake_writers()
+        self._on_close()
+
+    def _on_close(self):
+        pass
+
+    def _set_exited(self, exitcode):
+        with self.lock:
+            if self.closed:
+                return
+            self.exit_status = exitcode
+            self.status_event.set()
+            self.eof_received = True
+            self.in_buffer.close()
+            self.in_stderr_buffer.close()
+            if self._pipe is not None:
+                self._pipe.set_forever()
+        self._wake_writers()
@@ -8,4 +8,5 @@ setup(name='jumbonet',
       license='MIT',
       packages=['jumbonet'],
 	  install_requires=['paramiko',],
+	  extras_require={'zstd': ['zstandard',], 'numpy': ['numpy',],},
       zip_safe=False)